@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+from core.overlay import LODPolicy, OverlayStyle, draw_label
+from core.predictions import PredictionsCache
+from core.manifest import DatasetManifest
+from core.journal import apply_corrections, corrections_path, journal_path, read_corrections, replay
+from core.render import fitted_size, render_annotated
+from core.store import AnnotationStore
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def dataset_config(folder):
+    '''Category names and colors of a dataset, the colors are optional'''
+    with open(os.path.join(folder, 'classes.txt'), 'r') as f:
+        categories = [name.strip() for name in f.readlines()]
+    try:
+        with open(os.path.join(folder, 'config.json'), 'r') as f:
+            colors = json.load(f).get('category_colors', {})
+    except FileNotFoundError:
+        colors = {}
+    return categories, colors
+
+
+# -------------------------------------------------------------------------------
+# Worker processes
+# -------------------------------------------------------------------------------
+
+_worker = {}
+
+
+def init_worker(folder, categories, colors, max_size):
+    '''Per process state, so chunks only carry image names'''
+    _worker['folder'] = folder
+    _worker['categories'] = categories
+    _worker['style'] = OverlayStyle(colors, lod=LODPolicy())
+    _worker['max_size'] = max_size
+    # Read only: misses are parsed but not kept, the cache is only saved by the app
+    _worker['predictions'] = PredictionsCache(os.path.join(folder, 'predictions'), os.path.join(folder, '.cache', 'predictions'))
+
+
+def render_image(name, snapshot=None):
+    '''Preview of an image of the dataset with its predictions and corrections'''
+    folder = _worker['folder']
+    predictions = _worker['predictions'].read(os.path.splitext(name)[0] + '.txt', keep=False)
+    store = AnnotationStore.from_predictions(predictions, _worker['categories'], name)
+    if snapshot is None:
+        snapshot = read_corrections(corrections_path(folder, name), predictions)
+    if snapshot is not None:
+        apply_corrections(store, snapshot)
+
+    with Image.open(os.path.join(folder, 'images', name)) as image:
+        full_size = image.size
+        # JPEGs are decoded at a reduced scale close to the preview size, which is much faster
+        image.draft('RGB', fitted_size(full_size, _worker['max_size']))
+        image.load()
+        return render_annotated(image, store, _worker['max_size'], _worker['style'], full_size)
+
+
+def render_chunk(names, snapshots, output=None):
+    '''
+    Render a chunk of images. With an output folder the previews are saved there as JPEG, named
+    after the image with its extension (a.png.jpg) so that a.png and a.jpg don't share one,
+    otherwise they are returned as (size, RGB bytes) for a contact sheet. Images that can't
+    be read give None.
+    '''
+    results = []
+    for name in names:
+        try:
+            preview = render_image(name, snapshots.get(name))
+        except (OSError, ValueError):
+            results.append((name, None))
+            continue
+        if output is not None:
+            preview.save(os.path.join(output, name + '.jpg'), quality=90)
+            results.append((name, True))
+        else:
+            results.append((name, (preview.size, preview.tobytes())))
+    return results
+
+
+# -------------------------------------------------------------------------------
+# Contact sheets
+# -------------------------------------------------------------------------------
+
+class ContactSheet:
+    """Grid of previews with their names, written as numbered pages as they fill up"""
+    def __init__(self, output, columns, rows, cell_size, label_size=14):
+        self.output = output
+        self.columns = columns
+        self.rows = rows
+        self.cell_size = cell_size
+        self.label_size = label_size
+        self.page = None
+        self.count = 0
+        self.pages = 0
+
+    def add(self, name, preview):
+        if self.page is None:
+            self.page = Image.new('RGB', (self.columns * self.cell_size[0], self.rows * self.cell_size[1]))
+        col, row = self.count % self.columns, self.count // self.columns
+        x = col * self.cell_size[0] + (self.cell_size[0] - preview.width) // 2
+        y = row * self.cell_size[1] + (self.cell_size[1] - preview.height) // 2
+        self.page.paste(preview, (x, y))
+        draw_label(ImageDraw.Draw(self.page), (col * self.cell_size[0] + 2, row * self.cell_size[1] + 2), name, self.label_size)
+        self.count += 1
+        if self.count == self.columns * self.rows:
+            self.flush()
+
+    def flush(self):
+        if self.page is None:
+            return
+        self.pages += 1
+        self.page.save(os.path.join(self.output, f'sheet_{self.pages:04d}.jpg'), quality=90)
+        self.page = None
+        self.count = 0
+
+
+# -------------------------------------------------------------------------------
+# Batch
+# -------------------------------------------------------------------------------
+
+def print_progress(done, total, failed, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0
+    eta = (total - done) / rate if rate > 0 else 0
+    sys.stderr.write(f"\r{done}/{total} images, {rate:.1f} images/s, {failed} failed, ETA {eta:.0f}s ")
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def render_dataset(folder, output, max_size=(1024, 1024), sheet=None, workers=None, chunk_size=32,
+                   max_tasks_per_child=64, progress=print_progress):
+    '''
+    Render every image of a dataset with its predictions and corrections, one preview per
+    image in `output` or, with `sheet` as (columns, rows), contact sheets of previews fitted
+    in max_size. Chunks of images are rendered by a pool of processes. At most two chunks per
+    worker are in flight and workers are replaced after `max_tasks_per_child` chunks, which
+    bounds the memory of the parent and the workers. Returns the number of images rendered.
+    '''
+    os.makedirs(output, exist_ok=True)
+    manifest = DatasetManifest(folder)
+    manifest.scan(details=False)
+    names = manifest.names
+    categories, colors = dataset_config(folder)
+    # Corrections of the journal that are not in the corrected label files yet
+    latest, _ = replay(journal_path(folder))
+    contact_sheet = None if sheet is None else ContactSheet(output, *sheet, max_size)
+
+    workers = workers or os.cpu_count() or 1
+    done = failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        workers,
+        initializer=init_worker,
+        initargs=(folder, categories, colors, max_size),
+        max_tasks_per_child=max_tasks_per_child,
+    ) as executor:
+        chunks = chunked(names, chunk_size)
+        in_flight = deque()
+
+        def submit():
+            chunk = next(chunks, None)
+            if chunk is not None:
+                snapshots = {name: latest[name] for name in chunk if name in latest}
+                in_flight.append(executor.submit(render_chunk, chunk, snapshots, None if sheet else output))
+
+        for _ in range(2 * workers):
+            submit()
+        # Results are taken in order, so the contact sheets follow the order of the images
+        while in_flight:
+            results = in_flight.popleft().result()
+            submit()
+            for name, result in results:
+                if result is None:
+                    failed += 1
+                elif contact_sheet is not None:
+                    size, data = result
+                    contact_sheet.add(name, Image.frombytes('RGB', size, data))
+            done += len(results)
+            if progress is not None:
+                progress(done, len(names), failed, time.perf_counter() - start)
+
+    if contact_sheet is not None:
+        contact_sheet.flush()
+    return done - failed
@@ -0,0 +1,112 @@
+import os
+import math
+import sys
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from PIL import Image
+from core.pyramid import ImagePyramid
+
+
+def file_key(path):
+    '''Cache key of a file, changes whenever the file is modified'''
+    return os.path.abspath(path), os.stat(path).st_mtime_ns
+
+
+def sizeof(value):
+    '''Approximate memory used by a cached value in bytes'''
+    if isinstance(value, Image.Image):
+        bytes_per_band = 4 if value.mode in ('I', 'F') else 2 if value.mode.startswith('I;16') else 1
+        return value.width * value.height * len(value.getbands()) * bytes_per_band
+    if isinstance(value, ImagePyramid):
+        # The levels built later on by the viewer are counted up front, like the last one built
+        last = value.levels[-1]
+        nbytes = sum(sizeof(level) for level in value.levels)
+        per_pixel = sizeof(last) / max(1, last.width * last.height)
+        w, h = last.size
+        for _ in range(value.num_levels - len(value.levels)):
+            w, h = math.ceil(w / 2), math.ceil(h / 2)
+            nbytes += w * h * per_pixel
+        return int(nbytes)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread safe least-recently-used cache bounded by the total size of its values
+    in bytes instead of by the number of items.
+    """
+    def __init__(self, max_bytes=1024 * 2**20):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, value, nbytes=None):
+        nbytes = sizeof(value) if nbytes is None else nbytes
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+            if nbytes > self.max_bytes:
+                # Larger than the whole budget, don't wipe the cache for it
+                return value
+            self.items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+        return value
+
+    def get_or_load(self, key, load):
+        '''Get the value of the key, calling load() and storing its result on a miss'''
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = self.put(key, load())
+        return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value, nbytes = self.items.pop(key)
+            self.nbytes -= nbytes
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
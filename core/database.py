@@ -0,0 +1,333 @@
+import os
+import queue
+import logging
+import sqlite3
+from concurrent.futures import Future
+from threading import Thread, Event, Lock
+import numpy as np
+import pandas as pd
+from core.store import AnnotationStore
+from core.journal import apply_corrections
+
+logger = logging.getLogger(__name__)
+
+# Shared by all the datasets, for queries across them
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'labeling', 'annotations.sqlite')
+# Below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds (999), with the dataset id
+MAX_VARIABLES = 998
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    dataset_id INTEGER NOT NULL REFERENCES datasets(id),
+    name TEXT NOT NULL,
+    reviewed INTEGER NOT NULL DEFAULT 0,
+    prediction_mtime INTEGER,
+    prediction_size INTEGER,
+    UNIQUE (dataset_id, name)
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    image_id INTEGER NOT NULL REFERENCES images(id),
+    annotation_id INTEGER NOT NULL,
+    category INTEGER NOT NULL,
+    x1 REAL NOT NULL,
+    y1 REAL NOT NULL,
+    x2 REAL NOT NULL,
+    y2 REAL NOT NULL,
+    confidence REAL,
+    false_positive INTEGER NOT NULL DEFAULT 0,
+    false_negative INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (image_id, annotation_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS images_reviewed ON images (reviewed, dataset_id);
+CREATE INDEX IF NOT EXISTS annotations_category ON annotations (category, confidence);
+CREATE INDEX IF NOT EXISTS annotations_confidence ON annotations (confidence);
+CREATE INDEX IF NOT EXISTS annotations_false_positive ON annotations (false_positive, category);
+CREATE INDEX IF NOT EXISTS annotations_false_negative ON annotations (false_negative, category);
+'''
+
+
+def annotation_rows(image_id, ids, categories, bboxes, confidences, false_positive, false_negative):
+    '''Rows of the annotations table for the columns of an image'''
+    confidences = [None if np.isnan(c) else c for c in np.asarray(confidences, dtype=np.float64).tolist()]
+    return [
+        (image_id, i, c, x1, y1, x2, y2, conf, fp, fn)
+        for i, c, (x1, y1, x2, y2), conf, fp, fn in zip(
+            np.asarray(ids).tolist(),
+            np.asarray(categories).tolist(),
+            np.asarray(bboxes, dtype=np.float64).reshape(-1, 4).tolist(),
+            confidences,
+            np.asarray(false_positive, dtype=int).tolist(),
+            np.asarray(false_negative, dtype=int).tolist(),
+        )
+    ]
+
+
+class AnnotationDatabase:
+    """
+    SQLite (WAL) store of the annotations and corrections of any number of datasets, keyed
+    by image and annotation id, to query them across datasets without scanning folders.
+
+    Writes from the UI are queued and applied by a background thread, which commits
+    everything queued in a single transaction. Queries run on the calling thread with a
+    connection of their own, so thanks to WAL they do not wait for the writes.
+
+    A failing write is rolled back and logged without losing the rest of its batch, and
+    errors of submitted calls go to their future, so the thread never dies.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.lock = Lock()
+        self.read_lock = Lock()
+        self.queue = queue.Queue()
+        self.stopping = Event()
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def migrate(self):
+        '''Add the columns that databases created by older versions are missing'''
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(images)')}
+        for column in ('prediction_mtime', 'prediction_size'):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE images ADD COLUMN {column} INTEGER')
+        self.conn.commit()
+
+    # -------------------------------------------------------------------------------
+    # Writes
+    # -------------------------------------------------------------------------------
+
+    def dataset_id(self, dataset):
+        path = os.path.abspath(dataset)
+        self.conn.execute('INSERT OR IGNORE INTO datasets (path) VALUES (?)', (path,))
+        return self.conn.execute('SELECT id FROM datasets WHERE path = ?', (path,)).fetchone()[0]
+
+    def image_id(self, dataset_id, name):
+        self.conn.execute('INSERT OR IGNORE INTO images (dataset_id, name) VALUES (?, ?)', (dataset_id, name))
+        return self.conn.execute('SELECT id FROM images WHERE dataset_id = ? AND name = ?', (dataset_id, name)).fetchone()[0]
+
+    def save_image(self, dataset, image_fn, store, reviewed=None):
+        '''Queue the annotations of an image for writing, replacing the ones stored. Never blocks.'''
+        columns = (store.id.copy(), store.category_id.copy(), store.bbox.copy(), store.confidence.copy(),
+                   store.false_positive.copy(), store.false_negative.copy())
+        self.queue.put(('write', self._save_image, (dataset, image_fn, columns, reviewed), None))
+
+    def set_reviewed(self, dataset, image_fn, reviewed=True):
+        self.queue.put(('write', self._set_reviewed, (dataset, image_fn, reviewed), None))
+
+    def _save_image(self, dataset, image_fn, columns, reviewed):
+        image_id = self.image_id(self.dataset_id(dataset), image_fn)
+        self.conn.execute('DELETE FROM annotations WHERE image_id = ?', (image_id,))
+        self.conn.executemany('INSERT INTO annotations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', annotation_rows(image_id, *columns))
+        if reviewed is not None:
+            self.conn.execute('UPDATE images SET reviewed = ? WHERE id = ?', (int(reviewed), image_id))
+
+    def _set_reviewed(self, dataset, image_fn, reviewed):
+        image_id = self.image_id(self.dataset_id(dataset), image_fn)
+        self.conn.execute('UPDATE images SET reviewed = ? WHERE id = ?', (int(reviewed), image_id))
+
+    def import_predictions(self, dataset, names, load_predictions, load_corrections=None, stamps=None, chunk_size=MAX_VARIABLES):
+        '''
+        Bulk load the predictions of the images that are not in the database yet, or whose
+        predictions file changed according to `stamps`, its (mtime, size) by image name.
+        `load_predictions` gives the (N, 6) predictions of an image name and `load_corrections`
+        the corrections snapshot of an image for its predictions, or None, which are applied
+        before inserting. Images whose predictions can't be read are skipped, to be retried the
+        next time. Commits every `chunk_size` images and stops early when the database is closed.
+        Returns the number of images imported.
+        '''
+        stamps = stamps or {}
+        # The names of a chunk are bound as variables of a single query
+        chunk_size = min(chunk_size, MAX_VARIABLES)
+        with self.lock:
+            dataset_id = self.dataset_id(dataset)
+            known = {
+                name: (mtime, size)
+                for name, mtime, size in self.conn.execute('SELECT name, prediction_mtime, prediction_size FROM images WHERE dataset_id = ?', (dataset_id,))
+            }
+            self.conn.commit()
+        names = [name for name in names if name not in known or (name in stamps and known[name] != tuple(stamps[name]))]
+
+        imported = 0
+        for start in range(0, len(names), chunk_size):
+            if self.stopping.is_set():
+                break
+            columns = {}
+            for name in names[start:start + chunk_size]:
+                try:
+                    predictions = load_predictions(name)
+                    store = AnnotationStore.from_predictions(predictions)
+                    corrections = load_corrections(name, predictions) if load_corrections is not None else None
+                except (OSError, ValueError):
+                    logger.exception("Can't import the predictions of %s", name)
+                    continue
+                if corrections is not None:
+                    apply_corrections(store, corrections)
+                columns[name] = (store.id, store.category_id, store.bbox, store.confidence, store.false_positive, store.false_negative)
+            if not columns:
+                continue
+
+            chunk = list(columns)
+            with self.lock, self.conn:
+                self.conn.executemany('INSERT OR IGNORE INTO images (dataset_id, name) VALUES (?, ?)', [(dataset_id, name) for name in chunk])
+                ids = dict(self.conn.execute(
+                    f'SELECT name, id FROM images WHERE dataset_id = ? AND name IN ({",".join("?" * len(chunk))})',
+                    (dataset_id, *chunk),
+                ).fetchall())
+                self.conn.executemany(
+                    'UPDATE images SET prediction_mtime = ?, prediction_size = ? WHERE id = ?',
+                    [(*stamps.get(name, (None, None)), ids[name]) for name in chunk],
+                )
+                # Changed predictions replace the annotations stored for them
+                self.conn.executemany('DELETE FROM annotations WHERE image_id = ?', [(ids[name],) for name in chunk])
+                rows = []
+                for name in chunk:
+                    rows += annotation_rows(ids[name], *columns[name])
+                self.conn.executemany('INSERT INTO annotations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            imported += len(chunk)
+        return imported
+
+    def submit(self, function, *args):
+        '''Run a function in the writer thread, e.g. a bulk import. Returns a future with its result.'''
+        future = Future()
+        self.queue.put(('call', function, args, future))
+        return future
+
+    def flush(self):
+        '''Wait until everything queued is committed'''
+        done = Event()
+        self.queue.put(('call', done.set, (), None))
+        done.wait()
+
+    def close(self):
+        # A running import stops at its next chunk
+        self.stopping.set()
+        self.queue.put(('close', None, (), None))
+        self._thread.join()
+        self.conn.close()
+        self.reader.close()
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+
+            writes = [(function, args) for kind, function, args, _ in items if kind == 'write']
+            if writes:
+                self.write(writes)
+            for kind, function, args, future in items:
+                if kind == 'call':
+                    self.call(function, args, future)
+            if any(kind == 'close' for kind, _, _, _ in items):
+                return
+
+    def write(self, writes):
+        '''Apply writes in one transaction, or one by one if it fails so a bad write only loses itself'''
+        try:
+            with self.lock, self.conn:
+                for function, args in writes:
+                    function(*args)
+            return
+        except Exception:
+            if len(writes) == 1:
+                logger.exception("Write to the annotations database failed")
+                return
+        for write in writes:
+            self.write([write])
+
+    def call(self, function, args, future):
+        if future is not None and not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = function(*args)
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            if future is None:
+                logger.exception("Call in the annotations database thread failed")
+            else:
+                future.set_exception(e)
+            return
+        if future is not None:
+            future.set_result(result)
+
+    # -------------------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------------------
+
+    def images_with(self, category=None, false_positive=None, false_negative=None, reviewed=None,
+                    min_confidence=None, max_confidence=None, dataset=None):
+        '''
+        (dataset path, image name) of the images with at least one annotation matching all the
+        given conditions, e.g. images_with(category=2, false_positive=True, reviewed=False).
+        '''
+        conditions, params = [], []
+        for column, value in (('a.category', category), ('a.false_positive', false_positive), ('a.false_negative', false_negative), ('i.reviewed', reviewed)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(int(value))
+        if min_confidence is not None:
+            conditions.append('a.confidence >= ?')
+            params.append(min_confidence)
+        if max_confidence is not None:
+            conditions.append('a.confidence < ?')
+            params.append(max_confidence)
+        if dataset is not None:
+            conditions.append('d.path = ?')
+            params.append(os.path.abspath(dataset))
+
+        where = ' AND '.join(conditions) or '1'
+        with self.read_lock:
+            return self.reader.execute(
+                'SELECT DISTINCT d.path, i.name FROM annotations a '
+                'JOIN images i ON i.id = a.image_id JOIN datasets d ON d.id = i.dataset_id '
+                f'WHERE {where} ORDER BY d.path, i.name',
+                params,
+            ).fetchall()
+
+    def annotations(self, dataset, image_fn):
+        '''(N, 9) array with rows (annotation id, category, x1, y1, x2, y2, confidence, fp, fn) of an image'''
+        with self.read_lock:
+            rows = self.reader.execute(
+                'SELECT a.annotation_id, a.category, a.x1, a.y1, a.x2, a.y2, a.confidence, a.false_positive, a.false_negative '
+                'FROM annotations a JOIN images i ON i.id = a.image_id JOIN datasets d ON d.id = i.dataset_id '
+                'WHERE d.path = ? AND i.name = ? ORDER BY a.annotation_id',
+                (os.path.abspath(dataset), image_fn),
+            ).fetchall()
+        return np.array([[np.nan if v is None else v for v in row] for row in rows], dtype=np.float64).reshape(-1, 9)
+
+    def annotation_frame(self, dataset):
+        '''
+        DataFrame of all the annotations of a dataset with columns image (name), category,
+        confidence, size (longest side of the box), false_positive and false_negative
+        '''
+        with self.read_lock:
+            frame = pd.read_sql_query(
+                'SELECT i.name AS image, a.category, a.confidence, max(a.x2 - a.x1, a.y2 - a.y1) AS size, '
+                'a.false_positive, a.false_negative '
+                'FROM annotations a JOIN images i ON i.id = a.image_id JOIN datasets d ON d.id = i.dataset_id '
+                'WHERE d.path = ?',
+                self.reader, params=(os.path.abspath(dataset),),
+            )
+        return frame.astype({'category': np.int32, 'confidence': np.float32, 'size': np.float32, 'false_positive': bool, 'false_negative': bool})
+
+    def image_frame(self, dataset):
+        '''DataFrame of the images of a dataset with columns image (name) and reviewed'''
+        with self.read_lock:
+            frame = pd.read_sql_query(
+                'SELECT i.name AS image, i.reviewed FROM images i JOIN datasets d ON d.id = i.dataset_id WHERE d.path = ?',
+                self.reader, params=(os.path.abspath(dataset),),
+            )
+        return frame.astype({'reviewed': bool})
@@ -0,0 +1,111 @@
+from PIL import Image, ImageDraw
+
+
+class Effect:
+    """Transient drawing over a canvas rectangle. `paint(draw, x, y)` draws with (x, y) as the origin of the rectangle."""
+    def __init__(self, rect, paint):
+        self.rect = rect
+        self.paint = paint
+
+
+def hline(y, width, color, line_width=2):
+    '''Horizontal line across a canvas of the given width'''
+    top = y - line_width // 2
+    return Effect(
+        (0, top, width, top + line_width),
+        lambda draw, ox, oy: draw.line([(0, y - oy), (width, y - oy)], fill=color, width=line_width),
+    )
+
+
+def vline(x, height, color, line_width=2):
+    '''Vertical line across a canvas of the given height'''
+    left = x - line_width // 2
+    return Effect(
+        (left, 0, left + line_width, height),
+        lambda draw, ox, oy: draw.line([(x - ox, 0), (x - ox, height)], fill=color, width=line_width),
+    )
+
+
+def crosshair(x, y, size, color='#ffffff40', line_width=2):
+    return [hline(y, size[0], color, line_width), vline(x, size[1], color, line_width)]
+
+
+def rectangle(box, outline, line_width=2):
+    '''Outline of a rectangle, split in its four edges so the inside is not repainted'''
+    x1, y1, x2, y2 = box
+    w = line_width
+    edges = [
+        (x1, y1, x2 + 1, y1 + w),
+        (x1, y2 - w + 1, x2 + 1, y2 + 1),
+        (x1, y1 + w, x1 + w, y2 - w + 1),
+        (x2 - w + 1, y1 + w, x2 + 1, y2 - w + 1),
+    ]
+    paint = lambda draw, ox, oy: draw.rectangle((x1 - ox, y1 - oy, x2 - ox, y2 - oy), outline=outline, width=w)
+    return [Effect(edge, paint) for edge in edges]
+
+
+class EffectsLayer:
+    """
+    Composes transient effects (crosshair, rubber band, hover highlight) over a base frame.
+    The base is converted to RGBA once, and every render only restores the rectangles
+    touched by the previous effects and repaints the ones touched by the new effects.
+    """
+    def __init__(self):
+        self.source = None
+        self.tint = None
+        self.base = None
+        self.frame = None
+        self.dirty = []
+
+    def set_base(self, image):
+        '''Set a new base frame, the conversion to RGBA is delayed until an effect is drawn'''
+        self.source = image
+        self.base = None
+        self.frame = None
+        self.dirty = []
+
+    def prepare(self, tint=None):
+        if self.source is None:
+            return False
+        if self.base is None or tint != self.tint:
+            base = self.source if self.source.mode == 'RGBA' else self.source.convert('RGBA')
+            if tint is not None:
+                base = Image.alpha_composite(base, Image.new('RGBA', base.size, tint))
+            self.base = base
+            self.tint = tint
+            self.frame = base.copy()
+            self.dirty = []
+        return True
+
+    def clip(self, rect):
+        x1, y1, x2, y2 = (round(v) for v in rect)
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(self.base.width, x2), min(self.base.height, y2)
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return (x1, y1, x2, y2)
+
+    def render(self, effects=(), tint=None):
+        '''
+        Get the base frame with the effects drawn over it, optionally tinting the whole base
+        with an RGBA color. The returned frame is reused by the next render.
+        '''
+        if not self.prepare(tint):
+            return None
+
+        for rect in self.dirty:
+            self.frame.paste(self.base.crop(rect), rect[:2])
+        self.dirty = []
+
+        for effect in effects:
+            rect = self.clip(effect.rect)
+            if rect is None:
+                continue
+            x1, y1, x2, y2 = rect
+            layer = Image.new('RGBA', (x2 - x1, y2 - y1), (0, 0, 0, 0))
+            effect.paint(ImageDraw.Draw(layer), x1, y1)
+            region = Image.alpha_composite(self.frame.crop(rect), layer)
+            self.frame.paste(region, (x1, y1))
+            self.dirty.append(rect)
+
+        return self.frame
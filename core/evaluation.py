@@ -0,0 +1,295 @@
+import os
+import json
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from core.predictions import PredictionsCache
+from core.manifest import scan_folder
+from core.journal import corrected_labels, corrections_path, read_corrections
+
+
+IOU_THRESHOLDS = np.round(np.arange(0.5, 0.96, 0.05), 2)
+
+ImageMatches = namedtuple('ImageMatches', ['category', 'confidence', 'true_positive', 'ground_truth'])
+
+
+def iou_matrix(a, b):
+    '''IoU of every pair of (N, 4) and (M, 4) xyxy boxes, as an (N, M) matrix'''
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    width = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    height = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    intersection = width * height
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def match_image(predictions, ground_truth, iou_thresholds=IOU_THRESHOLDS):
+    '''
+    Greedy matching of the (N, 6) predictions of an image to its (M, 5+) ground truth rows, for
+    all the IoU thresholds at once. Predictions are taken by decreasing confidence and each one
+    takes the unmatched ground truth box of its category with the highest IoU, if it is above
+    the threshold. Returns the (T, N) true positive flags of the predictions.
+    '''
+    thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    true_positive = np.zeros((len(thresholds), len(predictions)), dtype=bool)
+    if len(predictions) == 0 or len(ground_truth) == 0:
+        return true_positive
+
+    iou = iou_matrix(predictions[:, 1:5], ground_truth[:, 1:5])
+    iou[predictions[:, 0, None] != ground_truth[None, :, 0]] = 0
+    order = np.argsort(-prediction_confidence(predictions), kind='stable')
+    # Predictions that overlap nothing enough are false positives at every threshold
+    order = order[iou.max(axis=1)[order] >= thresholds.min()]
+
+    matched = np.zeros((len(thresholds), len(ground_truth)), dtype=bool)
+    rows = np.arange(len(thresholds))
+    for i in order.tolist():
+        candidates = np.where(matched, -1.0, iou[i])
+        best = candidates.argmax(axis=1)
+        hit = candidates[rows, best] >= thresholds
+        true_positive[hit, i] = True
+        matched[rows[hit], best[hit]] = True
+    return true_positive
+
+
+def prediction_confidence(predictions):
+    '''Confidence of prediction rows, the ones without it count as certain'''
+    return np.nan_to_num(predictions[:, 5], nan=1.0)
+
+
+def evaluate_image(predictions, corrections, iou_thresholds=IOU_THRESHOLDS):
+    '''Matches of the raw predictions of an image against its corrected labels'''
+    ground_truth = corrected_labels(predictions, corrections) if corrections is not None else predictions
+    return ImageMatches(
+        predictions[:, 0].astype(np.int32),
+        prediction_confidence(predictions).astype(np.float32),
+        match_image(predictions, ground_truth, iou_thresholds),
+        ground_truth[:, 0].astype(np.int32),
+    )
+
+
+def average_precision(recall, precision):
+    '''All-point interpolated AP of (T, K) recall and precision curves sorted by decreasing confidence'''
+    recall = np.concatenate([np.zeros((len(recall), 1)), recall], axis=1)
+    # Precision envelope: the best precision at any higher recall
+    envelope = np.flip(np.maximum.accumulate(np.flip(precision, axis=1), axis=1), axis=1)
+    return np.sum(np.diff(recall, axis=1) * envelope, axis=1)
+
+
+class Evaluation:
+    """
+    Detection metrics of a dataset from the matches of its images: per class precision and
+    recall at a confidence threshold, PR curves and AP for each IoU threshold, and mAP.
+    Classes without ground truth have NaN AP and recall and are left out of mAP.
+    """
+    def __init__(self, matches, iou_thresholds=IOU_THRESHOLDS, score_threshold=None):
+        self.iou_thresholds = np.asarray(iou_thresholds)
+        self.images = len(matches)
+        T = len(self.iou_thresholds)
+        category = np.concatenate([m.category for m in matches] or [np.zeros(0, dtype=np.int32)])
+        confidence = np.concatenate([m.confidence for m in matches] or [np.zeros(0, dtype=np.float32)])
+        true_positive = np.concatenate([m.true_positive for m in matches] or [np.zeros((T, 0), dtype=bool)], axis=1)
+        ground_truth = np.concatenate([m.ground_truth for m in matches] or [np.zeros(0, dtype=np.int32)])
+
+        self.categories = np.union1d(category, ground_truth)
+        C = len(self.categories)
+        self.ground_truth = np.array([(ground_truth == c).sum() for c in self.categories], dtype=np.int64)
+        self.predictions = np.zeros(C, dtype=np.int64)
+        self.ap = np.full((C, T), np.nan)
+        self.precision = np.full(C, np.nan)
+        self.recall = np.full(C, np.nan)
+        self.curves = {}
+
+        order = np.argsort(-confidence, kind='stable')
+        for i, c in enumerate(self.categories.tolist()):
+            rows = order[category[order] == c]
+            self.predictions[i] = len(rows)
+            hits = np.cumsum(true_positive[:, rows], axis=1)
+            precision = hits / np.arange(1, len(rows) + 1)
+            recall = hits / self.ground_truth[i] if self.ground_truth[i] else np.full(hits.shape, np.nan)
+            self.curves[c] = (recall, precision)
+            if self.ground_truth[i]:
+                self.ap[i] = average_precision(recall, precision)
+
+            # Operating point at the first IoU threshold
+            kept = len(rows) if score_threshold is None else int((confidence[rows] >= score_threshold).sum())
+            tp = hits[0, kept - 1] if kept else 0
+            self.precision[i] = tp / kept if kept else np.nan
+            self.recall[i] = tp / self.ground_truth[i] if self.ground_truth[i] else np.nan
+
+    @property
+    def map(self):
+        '''mAP at each IoU threshold'''
+        if not np.any(self.ground_truth):
+            return np.full(len(self.iou_thresholds), np.nan)
+        return np.nanmean(self.ap[self.ground_truth > 0], axis=0)
+
+    @property
+    def map50(self):
+        return float(self.map[np.argmin(np.abs(self.iou_thresholds - 0.5))])
+
+    @property
+    def map50_95(self):
+        return float(np.mean(self.map))
+
+    def summary(self, names=()):
+        '''Table of the metrics by class'''
+        names = list(names)
+        lines = [f"{'class':<16}{'gt':>8}{'pred':>8}{'P':>8}{'R':>8}{'AP50':>8}{'AP50-95':>9}"]
+        ap50 = np.argmin(np.abs(self.iou_thresholds - 0.5))
+        for i, c in enumerate(self.categories.tolist()):
+            name = names[c] if 0 <= c < len(names) else str(c)
+            lines.append(
+                f"{name:<16}{self.ground_truth[i]:>8}{self.predictions[i]:>8}{self.precision[i]:>8.3f}"
+                f"{self.recall[i]:>8.3f}{self.ap[i, ap50]:>8.3f}{np.mean(self.ap[i]):>9.3f}"
+            )
+        lines.append(f"{'all':<16}{self.ground_truth.sum():>8}{self.predictions.sum():>8}{'':>16}{self.map50:>8.3f}{self.map50_95:>9.3f}")
+        return '\n'.join(lines)
+
+
+# -------------------------------------------------------------------------------
+# Worker processes
+# -------------------------------------------------------------------------------
+
+_worker = {}
+
+
+def init_worker(folder, iou_thresholds):
+    _worker['folder'] = folder
+    _worker['iou_thresholds'] = iou_thresholds
+    _worker['predictions'] = PredictionsCache(os.path.join(folder, 'predictions'), os.path.join(folder, '.cache', 'predictions'))
+
+
+def evaluate_chunk(names, snapshots):
+    '''Matches of a chunk of images, the corrections not in `snapshots` are read from the corrected label files'''
+    folder = _worker['folder']
+    results = []
+    for name in names:
+        predictions = _worker['predictions'].read(os.path.splitext(name)[0] + '.txt', keep=False)
+        corrections = snapshots.get(name)
+        if corrections is None:
+            corrections = read_corrections(corrections_path(folder, name), predictions)
+        results.append((name, evaluate_image(predictions, corrections, _worker['iou_thresholds'])))
+    return results
+
+
+class Evaluator:
+    """
+    Evaluation of the raw predictions of a dataset against its corrected labels. The matches
+    of each image are cached with a key made of the stats of its predictions file and its
+    corrections, in memory and in `.cache/evaluation`, so evaluating again after a few edits
+    only matches the images that changed. Large batches of images are matched by a pool of
+    processes.
+    """
+    def __init__(self, folder, iou_thresholds=IOU_THRESHOLDS, workers=None, chunk_size=256, min_parallel=1024):
+        self.folder = folder
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.min_parallel = min_parallel
+        self.cache_folder = os.path.join(folder, '.cache', 'evaluation')
+        self.results = {}
+        self.computed = 0
+        self.load()
+
+    def image_keys(self, names, snapshots):
+        '''Cache keys of the images, they end with ':none' for the images without corrections'''
+        predictions = scan_folder(os.path.join(self.folder, 'predictions'), ('.txt',))
+        corrections = scan_folder(os.path.join(self.folder, 'corrections'), ('.txt',))
+        keys = {}
+        for name in names:
+            label = os.path.splitext(name)[0] + '.txt'
+            if name in snapshots:
+                correction = 'journal:' + hashlib.sha1(json.dumps(snapshots[name], sort_keys=True).encode()).hexdigest()
+            elif label in corrections:
+                correction = 'file:{}:{}'.format(*corrections[label])
+            else:
+                correction = 'none'
+            keys[name] = 'predictions:{}:{}:'.format(*predictions.get(label, (-1, -1))) + correction
+        return keys
+
+    def evaluate(self, names, snapshots=None, reviewed=(), include_all=False, score_threshold=None, progress=None):
+        '''
+        Evaluate the images with corrections, from the journal `snapshots` or the corrected label
+        files, and the `reviewed` ones, whose predictions are right if they have no corrections.
+        With `include_all` every image is evaluated. Returns an Evaluation.
+        '''
+        snapshots = snapshots or {}
+        reviewed = set(reviewed)
+        keys = self.image_keys(names, snapshots)
+        selected = [name for name in names if include_all or name in reviewed or not keys[name].endswith(':none')]
+
+        stale = [name for name in selected if self.results.get(name, (None,))[0] != keys[name]]
+        self.computed = len(stale)
+        for name, matches in self.match(stale, snapshots, progress):
+            self.results[name] = (keys[name], matches)
+        return Evaluation([self.results[name][1] for name in selected], self.iou_thresholds, score_threshold)
+
+    def match(self, names, snapshots, progress=None):
+        if len(names) < self.min_parallel or self.workers == 1:
+            init_worker(self.folder, self.iou_thresholds)
+            for start in range(0, len(names), self.chunk_size):
+                yield from evaluate_chunk(names[start:start + self.chunk_size], snapshots)
+                if progress is not None:
+                    progress(min(start + self.chunk_size, len(names)), len(names))
+            return
+
+        chunks = [names[start:start + self.chunk_size] for start in range(0, len(names), self.chunk_size)]
+        done = 0
+        with ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.folder, self.iou_thresholds)) as executor:
+            futures = [
+                executor.submit(evaluate_chunk, chunk, {name: snapshots[name] for name in chunk if name in snapshots})
+                for chunk in chunks
+            ]
+            for future in futures:
+                results = future.result()
+                done += len(results)
+                yield from results
+                if progress is not None:
+                    progress(done, len(names))
+
+    # -------------------------------------------------------------------------------
+    # Cache
+    # -------------------------------------------------------------------------------
+
+    def load(self):
+        try:
+            with np.load(os.path.join(self.cache_folder, 'matches.npz')) as data:
+                if not np.array_equal(data['iou_thresholds'], self.iou_thresholds):
+                    return
+                names, keys = data['names'].tolist(), data['keys'].tolist()
+                offsets, gt_offsets = data['offsets'], data['gt_offsets']
+                category, confidence = data['category'], data['confidence']
+                true_positive, ground_truth = data['true_positive'], data['ground_truth']
+        except (OSError, ValueError, KeyError):
+            return
+        for i, (name, key) in enumerate(zip(names, keys)):
+            rows = slice(offsets[i], offsets[i + 1])
+            self.results[name] = (key, ImageMatches(
+                category[rows], confidence[rows], true_positive[:, rows], ground_truth[gt_offsets[i]:gt_offsets[i + 1]],
+            ))
+
+    def save(self):
+        names = sorted(self.results)
+        matches = [self.results[name][1] for name in names]
+        T = len(self.iou_thresholds)
+        os.makedirs(self.cache_folder, exist_ok=True)
+        # np.savez adds the extension to paths without it
+        tmp = os.path.join(self.cache_folder, 'matches.tmp.npz')
+        np.savez(
+            tmp,
+            iou_thresholds=self.iou_thresholds,
+            names=np.array(names, dtype=str),
+            keys=np.array([self.results[name][0] for name in names], dtype=str),
+            offsets=np.concatenate([[0], np.cumsum([len(m.category) for m in matches], dtype=np.int64)]),
+            gt_offsets=np.concatenate([[0], np.cumsum([len(m.ground_truth) for m in matches], dtype=np.int64)]),
+            category=np.concatenate([m.category for m in matches] or [np.zeros(0, dtype=np.int32)]),
+            confidence=np.concatenate([m.confidence for m in matches] or [np.zeros(0, dtype=np.float32)]),
+            true_positive=np.concatenate([m.true_positive for m in matches] or [np.zeros((T, 0), dtype=bool)], axis=1),
+            ground_truth=np.concatenate([m.ground_truth for m in matches] or [np.zeros(0, dtype=np.int32)]),
+        )
+        os.replace(tmp, os.path.join(self.cache_folder, 'matches.npz'))
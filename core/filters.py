@@ -0,0 +1,235 @@
+import re
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ('category', 'confidence', 'size', 'false_positive', 'false_negative')
+
+
+def store_columns(store):
+    '''Columns of an annotation store in the layout of the dataset table'''
+    bbox = store.bbox
+    return {
+        'category': store.category_id.astype(np.int32),
+        'confidence': store.confidence.astype(np.float32),
+        'size': np.maximum(bbox[:, 2] - bbox[:, 0], bbox[:, 3] - bbox[:, 1]).astype(np.float32),
+        'false_positive': store.false_positive.copy(),
+        'false_negative': store.false_negative.copy(),
+    }
+
+
+class AnnotationFilter:
+    """
+    Conditions on the annotations and images of a dataset. An image matches when it is in
+    the given reviewed state and has at least one annotation matching all the annotation
+    conditions. Conditions left as None are ignored, confidence and size ranges include
+    their bounds, and annotations without confidence never match a confidence range.
+    """
+    def __init__(self, categories=None, min_confidence=None, max_confidence=None, false_positive=None,
+                 false_negative=None, min_size=None, max_size=None, reviewed=None):
+        self.categories = None if categories is None else np.asarray(list(categories), dtype=np.int32)
+        self.min_confidence = min_confidence
+        self.max_confidence = max_confidence
+        self.false_positive = false_positive
+        self.false_negative = false_negative
+        self.min_size = min_size
+        self.max_size = max_size
+        self.reviewed = reviewed
+
+    @property
+    def on_annotations(self):
+        return any(value is not None for value in (
+            self.categories, self.min_confidence, self.max_confidence, self.false_positive,
+            self.false_negative, self.min_size, self.max_size,
+        ))
+
+    def mask(self, columns):
+        '''Annotations of a table or a dict of columns that match the annotation conditions'''
+        mask = np.ones(len(columns['category']), dtype=bool)
+        if self.categories is not None:
+            # A lookup table is several times faster than np.isin on millions of rows
+            category = columns['category']
+            lookup = np.zeros(max(category.max(initial=0), self.categories.max(initial=0)) + 1, dtype=bool)
+            lookup[self.categories] = True
+            mask &= lookup[category]
+        if self.min_confidence is not None:
+            mask &= columns['confidence'] >= self.min_confidence
+        if self.max_confidence is not None:
+            mask &= columns['confidence'] <= self.max_confidence
+        if self.false_positive is not None:
+            mask &= columns['false_positive'] == self.false_positive
+        if self.false_negative is not None:
+            mask &= columns['false_negative'] == self.false_negative
+        if self.min_size is not None:
+            mask &= columns['size'] >= self.min_size
+        if self.max_size is not None:
+            mask &= columns['size'] <= self.max_size
+        return mask
+
+
+class DatasetTable:
+    """
+    Dataset-wide table of annotations used to filter the images of a dataset. The rows are
+    kept sorted by image, as the index of the image in `names`, so a filter is a few vectorized
+    passes over the columns and a bincount by image.
+
+    Edited images are not rewritten in the table: their rows are marked dead and the columns
+    of their store are kept aside, so an edit only re-evaluates the filter on its own image.
+    """
+    def __init__(self, names, annotations=None, images=None):
+        self.names = list(names)
+        self.codes = {name: i for i, name in enumerate(self.names)}
+        n = len(self.names)
+
+        if annotations is None:
+            annotations = pd.DataFrame({'image': pd.Series(dtype=str), **{column: pd.Series(dtype=np.float32) for column in COLUMNS}})
+        image = pd.Categorical(annotations['image'], categories=self.names).codes
+        frame = annotations.drop(columns='image').assign(image=image)
+        # Annotations of images that are not in the list are dropped
+        frame = frame[frame['image'] >= 0].sort_values('image', kind='stable').reset_index(drop=True)
+        self.frame = frame
+        self.columns = {column: frame[column].to_numpy() for column in ('image', *COLUMNS)}
+        self.offsets = np.searchsorted(self.columns['image'], np.arange(n + 1))
+        self.alive = np.ones(len(frame), dtype=bool)
+        self.edited = {}
+        # For counts at any confidence threshold with a binary search
+        confidence = self.columns['confidence']
+        self.sorted_confidence = np.sort(confidence[~np.isnan(confidence)])
+        self.unscored = int(np.isnan(confidence).sum())
+
+        self.reviewed = np.zeros(n, dtype=bool)
+        if images is not None:
+            codes = pd.Categorical(images['image'], categories=self.names).codes
+            known = codes >= 0
+            self.reviewed[codes[known]] = images['reviewed'].to_numpy()[known]
+
+        self.filter = None
+        self.image_mask = np.ones(n, dtype=bool)
+
+    @classmethod
+    def from_database(cls, database, dataset, names):
+        return cls(names, database.annotation_frame(dataset), database.image_frame(dataset))
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def matches(self):
+        '''Indices in `names` of the images matching the filter, sorted'''
+        return np.flatnonzero(self.image_mask)
+
+    @property
+    def total(self):
+        '''Number of annotations, with the edits'''
+        dead = sum(self.offsets[code + 1] - self.offsets[code] for code in self.edited)
+        return len(self.alive) - dead + sum(len(columns['confidence']) for columns in self.edited.values())
+
+    def count_above(self, threshold=None):
+        '''Number of annotations not below a confidence threshold, annotations without confidence always count'''
+        if threshold is None:
+            return self.total
+        count = len(self.sorted_confidence) - np.searchsorted(self.sorted_confidence, threshold) + self.unscored
+        for code, columns in self.edited.items():
+            # The rows of edited images are replaced by the columns of their store
+            count -= np.count_nonzero(~(self.columns['confidence'][self.offsets[code]:self.offsets[code + 1]] < threshold))
+            count += np.count_nonzero(~(columns['confidence'] < threshold))
+        return int(count)
+
+    def apply(self, conditions):
+        '''Evaluate a filter on the whole dataset, None matches every image'''
+        self.filter = conditions
+        n = len(self.names)
+        if conditions is None:
+            self.image_mask = np.ones(n, dtype=bool)
+            return self.matches
+
+        if conditions.on_annotations:
+            mask = conditions.mask(self.columns) & self.alive
+            # Rows are sorted by image, reduce the runs of the images that have annotations
+            hits = np.zeros(n, dtype=bool)
+            nonempty = self.offsets[:-1] < self.offsets[1:]
+            if nonempty.any():
+                hits[nonempty] = np.logical_or.reduceat(mask, self.offsets[:-1][nonempty])
+            for code, columns in self.edited.items():
+                hits[code] = conditions.mask(columns).any()
+        else:
+            hits = np.ones(n, dtype=bool)
+        if conditions.reviewed is not None:
+            hits &= self.reviewed == conditions.reviewed
+        self.image_mask = hits
+        return self.matches
+
+    def image_matches(self, code):
+        conditions = self.filter
+        if conditions is None:
+            return True
+        if conditions.reviewed is not None and self.reviewed[code] != conditions.reviewed:
+            return False
+        if not conditions.on_annotations:
+            return True
+        columns = self.edited.get(code)
+        if columns is None:
+            rows = slice(self.offsets[code], self.offsets[code + 1])
+            columns = {column: self.columns[column][rows] for column in COLUMNS}
+        return bool(conditions.mask(columns).any())
+
+    def update_image(self, name, store):
+        '''Replace the annotations of an image with the ones of its store. Returns whether it matches.'''
+        code = self.codes.get(name)
+        if code is None:
+            return False
+        self.alive[self.offsets[code]:self.offsets[code + 1]] = False
+        self.edited[code] = store_columns(store)
+        self.image_mask[code] = self.image_matches(code)
+        return self.image_mask[code]
+
+    def set_reviewed(self, name, reviewed=True):
+        code = self.codes.get(name)
+        if code is None:
+            return False
+        self.reviewed[code] = reviewed
+        self.image_mask[code] = self.image_matches(code)
+        return self.image_mask[code]
+
+
+def column_bound(value, operator):
+    '''
+    Inclusive bound on the float32 columns for a comparison with a value. The value is rounded
+    to float32 like the columns, so that e.g. conf<=0.3 matches a confidence stored as 0.3, and
+    strict comparisons move it to the next float32 so that conf>0.3 doesn't.
+    '''
+    bound = np.float32(value)
+    if operator == '>':
+        bound = np.nextafter(bound, np.float32(np.inf))
+    elif operator == '<':
+        bound = np.nextafter(bound, np.float32(-np.inf))
+    return bound
+
+
+FILTER_TERM = re.compile(r'^(conf|size)(>=|<=|>|<)([0-9.eE+-]+)$')
+
+
+def parse_filter(text, categories):
+    '''
+    Filter from a query like "drop stripe conf>=0.5 size<20 fp unreviewed": category names,
+    confidence and size bounds, fp/fn (or !fp/!fn) and reviewed/unreviewed. Returns None for
+    an empty query and raises ValueError for unknown terms.
+    '''
+    conditions = {}
+    names = [name.lower() for name in categories]
+    for term in text.lower().split():
+        match = FILTER_TERM.match(term)
+        if match:
+            field, operator, value = match.groups()
+            bound = 'min' if operator.startswith('>') else 'max'
+            conditions[f"{bound}_{'confidence' if field == 'conf' else 'size'}"] = column_bound(float(value), operator)
+        elif term.lstrip('!') in ('fp', 'fn'):
+            field = 'false_positive' if term.lstrip('!') == 'fp' else 'false_negative'
+            conditions[field] = not term.startswith('!')
+        elif term in ('reviewed', 'unreviewed'):
+            conditions['reviewed'] = term == 'reviewed'
+        elif term in names:
+            conditions.setdefault('categories', []).append(names.index(term))
+        else:
+            raise ValueError(f"Unknown filter term '{term}'")
+    return AnnotationFilter(**conditions) if conditions else None
@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import queue
+import logging
+from threading import Thread, Event, Lock
+import numpy as np
+from core.predictions import read_predictions
+
+logger = logging.getLogger(__name__)
+
+
+def correction_snapshot(store):
+    '''Corrections of an annotation store: (category, x1, y1, x2, y2) rows of its false positives and false negatives'''
+    def rows(mask):
+        return np.column_stack([store.category_id[mask], store.bbox[mask]]).tolist()
+    return {'fp': rows(store.false_positive), 'fn': rows(store.false_negative)}
+
+
+def match_rows(rows, boxes, decimals=6):
+    '''
+    Index in `rows` of each one of the (category, x1, y1, x2, y2) `boxes`, -1 if missing. Rows
+    are compared rounded to `decimals`, which absorbs the error of the round trip through a label file.
+    '''
+    rows = np.round(np.asarray(rows, dtype=np.float64).reshape(-1, 5), decimals)
+    boxes = np.round(np.asarray(boxes, dtype=np.float64).reshape(-1, 5), decimals)
+    index = {}
+    for i, row in enumerate(map(tuple, rows.tolist())):
+        index.setdefault(row, i)
+    return np.array([index.get(box, -1) for box in map(tuple, boxes.tolist())], dtype=np.intp)
+
+
+def apply_corrections(store, corrections):
+    '''Mark the false positives and add the false negatives of a snapshot to a store built from predictions'''
+    rows = np.column_stack([store.category_id, store.bbox])
+    fp = match_rows(rows, corrections['fp'])
+    if (fp >= 0).any():
+        store.update(fp[fp >= 0], false_positive=True)
+    for cat, x1, y1, x2, y2 in corrections['fn']:
+        store.append(bbox=(x1, y1, x2, y2), category=store.category_name(int(cat)), false_negative=True)
+
+
+def corrections_from_labels(predictions, labels):
+    '''
+    Snapshot of a corrected label file: its rows without confidence were added, and the
+    predictions missing from it are false positives.
+    '''
+    added = np.isnan(labels[:, 5])
+    kept = match_rows(labels[~added, :5], predictions[:, :5])
+    return {'fp': predictions[kept < 0, :5].tolist(), 'fn': labels[added, :5].tolist()}
+
+
+def corrected_labels(predictions, corrections):
+    '''(N, 6) rows of the corrected labels: the predictions that are not false positives and the added boxes'''
+    fp = match_rows(predictions[:, :5], corrections['fp']) if len(corrections['fp']) else np.zeros(0, dtype=int)
+    keep = np.ones(len(predictions), dtype=bool)
+    keep[fp[fp >= 0]] = False
+    added = np.asarray(corrections['fn'], dtype=np.float64).reshape(-1, 5)
+    added = np.column_stack([added, np.full(len(added), np.nan)])
+    return np.concatenate([predictions[keep], added])
+
+
+def write_labels(path, labels):
+    '''Write YOLO labels atomically, rows without confidence are written with 5 columns'''
+    cat, x1, y1, x2, y2, conf = labels.T
+    xywh = np.column_stack([cat, (x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1])
+    lines = []
+    for row, c in zip(xywh.tolist(), conf.tolist()):
+        line = f"{int(row[0])} {row[1]!r} {row[2]!r} {row[3]!r} {row[4]!r}"
+        lines.append(line if np.isnan(c) else f"{line} {c!r}")
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def journal_path(folder):
+    return os.path.join(folder, '.cache', 'journal.jsonl')
+
+
+def corrections_path(folder, image_fn):
+    '''Corrected label file of an image of a dataset'''
+    return os.path.join(folder, 'corrections', os.path.splitext(image_fn)[0] + '.txt')
+
+
+def read_corrections(path, predictions):
+    '''Corrections of a corrected label file, None if there is none'''
+    if not os.path.exists(path):
+        return None
+    return corrections_from_labels(predictions, read_predictions(path))
+
+
+def replay(path):
+    '''
+    Latest snapshot of each image in a journal, and the length of its valid part. A torn last
+    record, from a crash while writing, is ignored.
+    '''
+    latest = {}
+    end = 0
+    try:
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                latest[record['image']] = {'fp': record['fp'], 'fn': record['fn']}
+                end += len(line)
+    except FileNotFoundError:
+        pass
+    return latest, end
+
+
+class CorrectionsJournal:
+    """
+    Write-behind persistence of the corrections of a dataset. Every edit appends a compact
+    record with the corrections of its image to an append-only journal, written by a
+    background thread that fsyncs batches of records at most every `sync_interval` seconds.
+    After `compact_every` records the journal is compacted into one corrected YOLO label file
+    per image, replaced atomically, and truncated.
+
+    Corrected label files have the predictions that are not false positives with their
+    confidence and the added boxes without it, so the corrections can be read back from them.
+    """
+    def __init__(self, folder, load_predictions, sync_interval=0.5, compact_every=500):
+        self.folder = folder
+        self.path = journal_path(folder)
+        self.labels_folder = os.path.join(folder, 'corrections')
+        self.load_predictions = load_predictions
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.lock = Lock()
+        self.latest, end = replay(self.path)
+        self.uncompacted = set(self.latest)
+        self.records = 0
+        self.queue = queue.Queue()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, 'a')
+        # Drop a torn record so the next ones are not appended to it
+        self._file.truncate(end)
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def labels_path(self, image_fn):
+        return corrections_path(self.folder, image_fn)
+
+    def corrections(self, image_fn, predictions):
+        '''Corrections of an image, from the journal or from its corrected label file'''
+        with self.lock:
+            snapshot = self.latest.get(image_fn)
+        if snapshot is not None:
+            return snapshot
+        return read_corrections(self.labels_path(image_fn), predictions)
+
+    def apply(self, image_fn, store, predictions):
+        '''Apply the saved corrections of the image to its store built from `predictions`'''
+        snapshot = self.corrections(image_fn, predictions)
+        if snapshot is not None:
+            apply_corrections(store, snapshot)
+
+    def record(self, image_fn, store):
+        '''Queue the corrections of the store for writing if they changed, returns whether they did. Never blocks.'''
+        snapshot = correction_snapshot(store)
+        with self.lock:
+            if self.latest.get(image_fn) == snapshot:
+                return False
+            self.latest[image_fn] = snapshot
+        self.queue.put(('record', image_fn, snapshot))
+        return True
+
+    def compact(self):
+        self.queue.put(('compact',))
+
+    def flush(self):
+        '''Wait until everything queued is on disk'''
+        done = Event()
+        self.queue.put(('sync', done))
+        done.wait()
+
+    def close(self, compact=True):
+        if compact:
+            self.compact()
+        self.queue.put(('close',))
+        self._thread.join()
+
+    # -------------------------------------------------------------------------------
+    # Writer thread
+    # -------------------------------------------------------------------------------
+
+    def run(self):
+        dirty = False
+        last_sync = time.monotonic()
+        while True:
+            try:
+                items = [self.queue.get(timeout=self.sync_interval)]
+            except queue.Empty:
+                items = []
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+
+            waiting = [item[1] for item in items if item[0] == 'sync']
+            closing = any(item[0] == 'close' for item in items)
+            # Images are marked before writing, so the snapshot of a record that fails to be
+            # written stays in `latest` and is still written at the next compaction
+            self.uncompacted.update(item[1] for item in items if item[0] == 'record')
+            for item in items:
+                try:
+                    if item[0] == 'record':
+                        _, image_fn, snapshot = item
+                        self._file.write(self.format_record(image_fn, snapshot))
+                        self.records += 1
+                        dirty = True
+                    elif item[0] == 'compact':
+                        self._compact()
+                        dirty = False
+                except Exception:
+                    logger.exception("Writing the corrections journal failed")
+
+            try:
+                if dirty and (waiting or closing or time.monotonic() - last_sync >= self.sync_interval):
+                    self._sync()
+                    dirty = False
+                    last_sync = time.monotonic()
+                if self.records >= self.compact_every:
+                    self._compact()
+            except Exception:
+                logger.exception("Writing the corrections journal failed")
+            for done in waiting:
+                done.set()
+            if closing:
+                self._file.close()
+                return
+
+    @staticmethod
+    def format_record(image_fn, snapshot):
+        return json.dumps({'image': image_fn, **snapshot}, separators=(',', ':')) + '\n'
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _compact(self):
+        '''
+        Write the corrected labels of the images in the journal and truncate it. The images whose
+        labels can't be written are kept in the journal, to be retried at the next compaction.
+        '''
+        if not self.uncompacted:
+            return
+        self._sync()
+        os.makedirs(self.labels_folder, exist_ok=True)
+        failed = {}
+        for image_fn in sorted(self.uncompacted):
+            with self.lock:
+                snapshot = self.latest[image_fn]
+            path = self.labels_path(image_fn)
+            try:
+                if not snapshot['fp'] and not snapshot['fn']:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                write_labels(path, corrected_labels(self.load_predictions(image_fn), snapshot))
+            except (OSError, ValueError):
+                logger.exception("Can't write the corrected labels of %s", image_fn)
+                failed[image_fn] = snapshot
+
+        # Everything else in the journal is in the label files now
+        self._file.close()
+        self._file = open(self.path, 'w')
+        for image_fn, snapshot in failed.items():
+            self._file.write(self.format_record(image_fn, snapshot))
+        self._sync()
+        self.uncompacted = set(failed)
+        self.records = len(failed)
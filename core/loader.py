@@ -0,0 +1,59 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image
+
+
+def open_draft(path, size):
+    '''
+    Fast reduced decode of a JPEG that is at least as big as `size`. Returns the draft and
+    the full size of the image, or None if the image format doesn't support drafts.
+    '''
+    image = Image.open(path)
+    full_size = image.size
+    if image.format != 'JPEG' or image.draft('RGB', size) is None:
+        return None
+    if image.size == full_size:
+        return None
+    image.load()
+    return image, full_size
+
+
+class LatestLoader:
+    """
+    Runs the stages of a load request (e.g. a draft and the full decode) in the background.
+    Only the latest request matters: issuing a new one cancels the pending stages of the
+    previous one and the results of the stages that were already running are dropped.
+    """
+    def __init__(self, max_workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='loader')
+        self.generation = 0
+        self.stages = {}
+
+    def request(self, **stages):
+        '''Start a new request. Each stage is either a callable to run or a future already running.'''
+        self.cancel()
+        self.generation += 1
+        for name, stage in stages.items():
+            self.stages[name] = stage if isinstance(stage, Future) else self.executor.submit(stage)
+        return self.generation
+
+    def cancel(self):
+        for future in self.stages.values():
+            future.cancel()
+        self.stages = {}
+
+    def done(self):
+        return not self.stages
+
+    def poll(self):
+        '''Pop the finished stages of the latest request as a {name: future} dict'''
+        finished = {}
+        for name, future in list(self.stages.items()):
+            if future.done():
+                del self.stages[name]
+                if not future.cancelled():
+                    finished[name] = future
+        return finished
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,147 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+ManifestEntry = namedtuple(
+    'ManifestEntry',
+    ['image_mtime', 'image_size', 'width', 'height', 'prediction_mtime', 'prediction_size', 'boxes'],
+)
+
+
+def scan_folder(folder, extensions):
+    '''(mtime_ns, size) of the files of a folder with the given extensions, by name'''
+    files = {}
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(extensions) and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        pass
+    return files
+
+
+def count_boxes(path):
+    with open(path, 'rb') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def image_dimensions(path):
+    '''Width and height from the header of the image, without decoding it'''
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except OSError:
+        return -1, -1
+
+
+class DatasetManifest:
+    """
+    Sorted index of the images of a dataset with the stats of their files, their dimensions
+    and the number of boxes in their predictions. It is stored in the dataset folder so the
+    list is available as soon as the dataset is opened, and rescans only look at the files
+    whose mtime or size changed. Unknown values are -1, as are the stats of a missing
+    predictions file.
+    """
+    def __init__(self, folder, images_folder='images', predictions_folder='predictions', path=None):
+        self.images_folder = os.path.join(folder, images_folder)
+        self.predictions_folder = os.path.join(folder, predictions_folder)
+        self.path = path or os.path.join(folder, '.cache', 'manifest.npz')
+        self.names = []
+        self.entries = {}
+        self._executor = None
+        self.load()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        return self.entries[name]
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def load(self):
+        try:
+            with np.load(self.path) as data:
+                names = data['names'].tolist()
+                columns = [data[field].tolist() for field in ManifestEntry._fields]
+        except (OSError, ValueError, KeyError):
+            return False
+        self.entries = {name: ManifestEntry(*values) for name, *values in zip(names, *columns)}
+        self.names = names
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        entries = [self.entries[name] for name in self.names]
+        columns = {
+            field: np.array([entry[i] for entry in entries], dtype=np.int64)
+            for i, field in enumerate(ManifestEntry._fields)
+        }
+        # np.savez adds the extension to paths without it
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, names=np.array(self.names, dtype=str), **columns)
+        os.replace(tmp, self.path)
+
+    def prediction_name(self, image_name):
+        return os.path.splitext(image_name)[0] + '.txt'
+
+    def scan(self, details=True):
+        '''
+        Update the manifest with the current files. Without `details`, only the file stats are
+        updated, and the dimensions and box counts of new or modified files are left unknown
+        for a later detailed scan. Returns whether the list of images changed.
+        '''
+        images = scan_folder(self.images_folder, IMAGE_EXTENSIONS)
+        predictions = scan_folder(self.predictions_folder, ('.txt',))
+
+        entries = {}
+        for name, (image_mtime, image_size) in images.items():
+            prediction_mtime, prediction_size = predictions.get(self.prediction_name(name), (-1, -1))
+            old = self.entries.get(name)
+
+            if old is not None and (old.image_mtime, old.image_size) == (image_mtime, image_size) and old.width >= 0:
+                width, height = old.width, old.height
+            elif details:
+                width, height = image_dimensions(os.path.join(self.images_folder, name))
+            else:
+                width, height = -1, -1
+
+            if prediction_mtime < 0:
+                boxes = 0
+            elif old is not None and (old.prediction_mtime, old.prediction_size) == (prediction_mtime, prediction_size) and old.boxes >= 0:
+                boxes = old.boxes
+            elif details:
+                boxes = count_boxes(os.path.join(self.predictions_folder, self.prediction_name(name)))
+            else:
+                boxes = -1
+
+            entries[name] = ManifestEntry(image_mtime, image_size, width, height, prediction_mtime, prediction_size, boxes)
+
+        names = sorted(entries)
+        changed = names != self.names
+        self.entries, self.names = entries, names
+        return changed
+
+    def rescan(self, details=True):
+        '''Scan and save in a background thread, returns a future with the result of scan'''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+        def task():
+            changed = self.scan(details)
+            self.save()
+            return changed
+        return self._executor.submit(task)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
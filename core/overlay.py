@@ -0,0 +1,430 @@
+import math
+from functools import lru_cache
+from itertools import compress
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+def annotation_columns(annotations):
+    '''
+    Everything about the annotations that affects how they are drawn, as columns: (N, 4) boxes,
+    categories and the visible, false positive and false negative flags. Annotation stores give
+    their own columns, lists of annotations are gathered.
+    '''
+    if hasattr(annotations, 'columns'):
+        return annotations.columns()
+    category = np.empty(len(annotations), dtype=object)
+    category[:] = [annot.category for annot in annotations]
+    return {
+        'bbox': np.array([annot.bbox for annot in annotations], dtype=np.float64).reshape(-1, 4),
+        'category': category,
+        'visible': np.array([annot.visible for annot in annotations], dtype=bool),
+        'false_positive': np.array([annot.false_positive for annot in annotations], dtype=bool),
+        'false_negative': np.array([annot.false_negative for annot in annotations], dtype=bool),
+    }
+
+
+def changed_rows(columns, previous):
+    '''Indices of the rows that differ between two sets of columns, rows only in one of them included'''
+    n, m = len(columns['bbox']), len(previous['bbox'])
+    common = min(n, m)
+    changed = np.zeros(common, dtype=bool)
+    for name, values in columns.items():
+        diff = values[:common] != previous[name][:common]
+        changed |= diff.any(axis=1) if diff.ndim > 1 else diff
+    return np.concatenate([np.flatnonzero(changed), np.arange(common, max(n, m))])
+
+
+class LODPolicy:
+    """
+    Level of detail of the boxes according to their on-screen size (longest side in pixels).
+    Boxes smaller than `text_size` drop their label, smaller than `detail_size` also their fill
+    and markers, and smaller than `density_size` are collapsed into one density glyph per
+    `density_cell` x `density_cell` cell of the canvas.
+    """
+    FULL, NO_TEXT, OUTLINE, DENSITY = range(4)
+
+    def __init__(self, text_size=24, detail_size=8, density_size=3, density_cell=12):
+        self.text_size = text_size
+        self.detail_size = detail_size
+        self.density_size = density_size
+        self.density_cell = density_cell
+
+    def key(self):
+        return (self.text_size, self.detail_size, self.density_size, self.density_cell)
+
+    def levels(self, boxes):
+        '''Level of detail of each one of the (N, 4) canvas boxes'''
+        sizes = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        return np.select(
+            [sizes < self.density_size, sizes < self.detail_size, sizes < self.text_size],
+            [self.DENSITY, self.OUTLINE, self.NO_TEXT],
+            self.FULL,
+        )
+
+
+class OverlayStyle:
+    """Colors and sizes used to draw the annotations at a given zoom (scale relative to fit)"""
+    def __init__(self, colors=None, default_color='#00ff00', fill_intensity=50, scale=1, lod=None):
+        self.colors = colors or {}
+        self.default_color = default_color
+        self.fill_intensity = fill_intensity
+        self.scale = scale
+        self.lod = lod
+        self.line_width = round((3 - scale) / 2 + 1) if scale <= 3 else 1
+        self.marker_size = 1 + round(scale) / 2
+        self.font_size = 10 if scale <= 2 else 10 + round((scale - 2) * 2)
+
+    def color(self, category):
+        return self.colors.get(category, self.default_color)
+
+    @property
+    def pad(self):
+        return self.font_size + self.marker_size + 4
+
+    def extent(self, box, label):
+        '''Canvas rectangle covered by a box drawn with its markers and label'''
+        x1, y1, x2, y2 = box
+        return (x1 - self.pad, y1 - self.pad, max(x2, x1 + len(label) * self.font_size) + self.pad, y2 + self.pad)
+
+    def extents(self, boxes, label_lengths):
+        '''Vectorized extent of (N, 4) boxes'''
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        right = np.maximum(boxes[:, 2], boxes[:, 0] + np.asarray(label_lengths) * self.font_size)
+        return np.stack([boxes[:, 0] - self.pad, boxes[:, 1] - self.pad, right + self.pad, boxes[:, 3] + self.pad], axis=1)
+
+
+def label_lengths(indices):
+    '''Number of digits of the 1-based labels of the given indices'''
+    return np.floor(np.log10(np.asarray(indices) + 1)).astype(int) + 1
+
+
+def transform_boxes(bboxes, affine):
+    '''Apply the affine to (N, 4) xyxy boxes, transforming all the corners with a single product'''
+    affine = np.asarray(affine, dtype=np.float64)
+    corners = np.asarray(bboxes, dtype=np.float64).reshape(-1, 2)
+    return (corners @ affine[:2, :2].T + affine[:2, 2]).reshape(-1, 4)
+
+
+@lru_cache(maxsize=None)
+def label_font(size):
+    return ImageFont.load_default(size)
+
+
+@lru_cache(maxsize=None)
+def char_glyph(char, size):
+    '''Rendered mask of a single character, its offset from the pen position and its advance'''
+    font = label_font(size)
+    left, top, right, bottom = font.getbbox(char)
+    mask = Image.new('L', (max(1, right - left), max(1, bottom - top)))
+    ImageDraw.Draw(mask).text((-left, -top), char, fill=255, font=font)
+    return mask, (left, top), font.getlength(char)
+
+
+@lru_cache(maxsize=16384)
+def label_glyph(text, size):
+    '''
+    Mask of a label and its offset from the text origin. Labels are composed from the cached
+    glyphs of their characters, which is much cheaper than laying out the text every time.
+    '''
+    glyphs = []
+    pen = 0.0
+    for char in text:
+        mask, (left, top), advance = char_glyph(char, size)
+        glyphs.append((mask, round(pen) + left, top))
+        pen += advance
+
+    if not glyphs:
+        return Image.new('L', (1, 1)), (0, 0)
+    x0 = min(x for _, x, _ in glyphs)
+    y0 = min(y for _, _, y in glyphs)
+    x1 = max(x + mask.width for mask, x, _ in glyphs)
+    y1 = max(y + mask.height for mask, _, y in glyphs)
+    label = Image.new('L', (x1 - x0, y1 - y0))
+    for mask, x, y in glyphs:
+        label.paste(mask, (x - x0, y - y0), mask)
+    return label, (x0, y0)
+
+
+def draw_label(draw, xy, text, size, fill="white"):
+    '''Same as draw.text but reusing the rendered glyphs of the label'''
+    mask, (dx, dy) = label_glyph(text, size)
+    draw.bitmap((xy[0] + dx, xy[1] + dy), mask, fill=fill)
+
+
+def draw_labels(draw, positions, labels, size, fill="white"):
+    '''
+    Draw many labels at once: the glyphs of all their characters are scattered into one mask
+    with a few vectorized passes per character, and the mask is drawn with a single bitmap.
+    '''
+    if len(labels) == 0:
+        return
+    text = ''.join(labels)
+    if not text.isascii():
+        for xy, label in zip(positions, labels):
+            draw_label(draw, xy, label, size, fill)
+        return
+    chars = np.frombuffer(text.encode(), dtype=np.uint8)
+    lengths = np.fromiter(map(len, labels), dtype=np.int64, count=len(labels))
+    glyphs = {c: char_glyph(chr(c), size) for c in np.flatnonzero(np.bincount(chars, minlength=256)).tolist()}
+    advances = np.zeros(256)
+    for c, (_, _, advance) in glyphs.items():
+        advances[c] = advance
+    # Pen position of every character in its label, as label_glyph lays them out
+    pen = np.cumsum(advances[chars]) - advances[chars]
+    first = np.cumsum(lengths) - lengths
+    pen -= np.repeat(pen[first], lengths)
+    origins = np.repeat(np.asarray(positions, dtype=np.int64).reshape(-1, 2), lengths, axis=0)
+    origins[:, 0] += np.round(pen).astype(np.int64)
+
+    width, height = draw.im.size
+    # A margin as big as the glyphs, so their pixels never need clipping
+    margin = 2 * size + 2
+    inside = (origins[:, 0] > -margin // 2) & (origins[:, 0] < width) & (origins[:, 1] > -margin // 2) & (origins[:, 1] < height)
+    chars, origins = chars[inside], origins[inside] + margin
+    stride = width + 2 * margin
+    mask = np.zeros((height + 2 * margin) * stride, dtype=np.uint8)
+    starts = origins[:, 1] * stride + origins[:, 0]
+    for c, (glyph, (left, top), _) in glyphs.items():
+        # As label_glyph composes it, pasting the glyph through itself
+        pixels = np.asarray(glyph).astype(np.uint16)
+        pixels = ((pixels * pixels + 128 + ((pixels * pixels + 128) >> 8)) >> 8).astype(np.uint8)
+        gy, gx = np.nonzero(pixels)
+        offsets = (gy + top) * stride + gx + left
+        at = starts[chars == c]
+        # Overlapping labels just overwrite each other
+        mask[(at[:, None] + offsets).ravel()] = np.tile(pixels[gy, gx], len(at))
+    mask = mask.reshape(-1, stride)[margin:margin + height, margin:margin + width]
+    draw.im.paste(Image.new(draw.im.mode, (width, height), fill).im, (0, 0, width, height), Image.fromarray(np.ascontiguousarray(mask)).im)
+
+
+def draw_fill(draw, box, color, style):
+    draw.rectangle(box, fill=f'{color}{style.fill_intensity:02X}')
+
+
+def draw_outline(draw, box, annot, color, label, style):
+    x1, y1, x2, y2 = box
+    draw.rectangle(box, outline=color, width=style.line_width)
+
+    if annot.false_negative:
+        draw.circle((x2, y1), style.marker_size, fill='black')
+
+    if annot.false_positive:
+        # Draw a cross in upper right corner
+        size = style.marker_size
+        draw.line((x2 - size, y1 - size, x2 + size, y1 + size), fill='red', width=2)
+        draw.line((x2 - size, y1 + size, x2 + size, y1 - size), fill='red', width=2)
+
+    if label is not None:
+        size = style.font_size
+        draw_label(draw, (x1 - size // 2, y1 - size // 2), label, size)
+
+
+class AnnotationOverlay:
+    """
+    RGBA layer with all the annotations of an image drawn in a single pass. The layer is
+    cached for the current affine, canvas size and style, and when only a few annotations
+    change between renders, only the regions they cover are redrawn.
+    """
+    def __init__(self, max_dirty=0.25):
+        self.max_dirty = max_dirty
+        self.image = None
+        self.key = None
+        self.version = None
+        self.columns = None
+        self.boxes = None
+        self.full_renders = 0
+        self.partial_renders = 0
+        self.primitives = 0
+
+    def invalidate(self):
+        self.image = None
+        self.key = None
+
+    def render(self, annotations, affine, size, style, simplified=False, version=None, indices=None, changed=None):
+        '''
+        Get the overlay of the annotations (a list or an AnnotationStore). `version` identifies
+        the annotation set; if it is the same as in the last render the cached layer is returned
+        without looking for changes. `indices` restricts drawing to the annotations that may be
+        on screen (viewport culling). `changed` are the rows edited since the last render when
+        they are known, which saves comparing all the annotations to find them.
+        The returned image is shared, copy it before drawing on it.
+        '''
+        size = (int(size[0]), int(size[1]))
+        key = (np.asarray(affine).tobytes(), size, style.scale, style.lod and style.lod.key(), simplified)
+        if self.image is not None and key == self.key and version is not None and version == self.version:
+            return self.image
+
+        self.primitives = 0
+        # Copies, so that in-place edits of a store show up as changes in the next render
+        columns = {name: values.copy() for name, values in annotation_columns(annotations).items()}
+        boxes = self.transform(columns['bbox'], affine)
+        indices = np.arange(len(boxes)) if indices is None else np.asarray(indices, dtype=np.intp)
+
+        if self.image is None or key != self.key:
+            self.redraw(columns, boxes, size, style, simplified, indices)
+        else:
+            regions = self.dirty_regions(columns, boxes, style, size, changed)
+            if regions is None:
+                self.redraw(columns, boxes, size, style, simplified, indices)
+            else:
+                for region in regions:
+                    self.redraw_region(region, columns, boxes, style, simplified, indices)
+                self.partial_renders += len(regions) > 0
+
+        self.key = key
+        self.version = version
+        self.columns = columns
+        self.boxes = boxes
+        return self.image
+
+    @staticmethod
+    def transform(bboxes, affine):
+        '''Canvas boxes (N, 4), rounded so that regions redraw exactly like the full layer'''
+        return np.rint(transform_boxes(bboxes, affine))
+
+    def dirty_regions(self, columns, boxes, style, size, changed=None):
+        '''Canvas regions affected by the changes since the last render, or None if it is cheaper to redraw everything'''
+        if changed is None:
+            changed = changed_rows(columns, self.columns)
+        changed = np.unique(np.asarray(changed, dtype=np.intp))
+
+        extents = []
+        for state, canvas_boxes in ((self.columns, self.boxes), (columns, boxes)):
+            rows = changed[changed < len(canvas_boxes)]
+            rows = rows[state['visible'][rows]]
+            extents.append(style.extents(canvas_boxes[rows], label_lengths(rows)))
+
+        regions = [self.clip(rect, size) for rect in np.concatenate(extents).tolist()]
+        regions = [r for r in regions if r is not None]
+        area = sum((r[2] - r[0]) * (r[3] - r[1]) for r in regions)
+        if area > self.max_dirty * size[0] * size[1]:
+            return None
+        return regions
+
+    @staticmethod
+    def clip(rect, size):
+        x1 = max(0, math.floor(rect[0]))
+        y1 = max(0, math.floor(rect[1]))
+        x2 = min(size[0], math.ceil(rect[2]))
+        y2 = min(size[1], math.ceil(rect[3]))
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return (x1, y1, x2, y2)
+
+    def redraw(self, columns, boxes, size, style, simplified=False, indices=None):
+        self.image = Image.new('RGBA', size, (0, 0, 0, 0))
+        indices = np.arange(len(boxes)) if indices is None else indices
+        self.primitives += self.draw(self.image, indices, columns, boxes, style, simplified)
+        self.full_renders += 1
+
+    def redraw_region(self, region, columns, boxes, style, simplified=False, indices=None):
+        '''Redraw the annotations that intersect the region and paste them over it'''
+        x1, y1, x2, y2 = region
+        if style.lod is not None:
+            # Align to the density cells so the glyphs count the same boxes as in a full render
+            cell = style.lod.density_cell
+            x1, y1 = x1 // cell * cell, y1 // cell * cell
+            x2 = min(self.image.width, -(-x2 // cell) * cell)
+            y2 = min(self.image.height, -(-y2 // cell) * cell)
+        indices = np.arange(len(boxes)) if indices is None else indices
+        extents = style.extents(boxes[indices], label_lengths(indices))
+        inside = (extents[:, 0] < x2) & (extents[:, 2] > x1) & (extents[:, 1] < y2) & (extents[:, 3] > y1)
+        indices = indices[inside]
+        layer = Image.new('RGBA', (x2 - x1, y2 - y1), (0, 0, 0, 0))
+        self.primitives += self.draw(layer, indices, columns, boxes - (x1, y1, x1, y1), style, simplified, origin=(x1, y1))
+        self.image.paste(layer, (x1, y1))
+
+    @staticmethod
+    def draw(image, indices, columns, boxes, style, simplified=False, origin=(0, 0)):
+        '''Draw the visible annotations at the given indices in one batch, returns the number of primitives drawn'''
+        indices = np.asarray(indices, dtype=np.intp)
+        indices = indices[columns['visible'][indices]]
+        return draw_boxes(
+            ImageDraw.Draw(image),
+            boxes[indices],
+            columns['category'][indices],
+            columns['false_positive'][indices],
+            columns['false_negative'][indices],
+            [str(ix + 1) for ix in indices.tolist()],
+            style,
+            simplified,
+            origin,
+        )
+
+
+def draw_boxes(draw, boxes, categories, false_positive, false_negative, labels, style, simplified=False, origin=(0, 0)):
+    '''
+    Draw a batch of canvas boxes (N, 4) with a single ImageDraw. Positions of markers and labels
+    are computed for the whole batch at once, and fills are drawn first so they never hide outlines.
+    With a level of detail policy in the style, small boxes are drawn with less detail. `origin` is
+    the position of the image in the full canvas, to align the density cells.
+    Returns the number of primitives drawn.
+    '''
+    if len(boxes) == 0:
+        return 0
+    boxes = np.asarray(boxes, dtype=np.int64)
+    categories = np.asarray(categories, dtype=object)
+    colors = {category: style.color(category) for category in set(categories.tolist())}
+    if style.lod is not None:
+        levels = style.lod.levels(boxes)
+    else:
+        levels = np.full(len(boxes), LODPolicy.FULL)
+    primitives = 0
+
+    outlined = levels <= LODPolicy.OUTLINE
+    detailed = levels <= LODPolicy.NO_TEXT
+    # The primitives go straight to the core drawing object with the inks resolved once per
+    # color, the ImageDraw wrappers parse the color again for every call
+    rectangle = draw.draw.draw_rectangle
+    box_list, category_list = boxes.tolist(), categories.tolist()
+    inks = {category: draw._getink(color)[0] for category, color in colors.items()}
+    if simplified:
+        for box, category in compress(zip(box_list, category_list), outlined.tolist()):
+            rectangle(box, inks[category], 0, 1)
+        primitives += int(outlined.sum())
+    else:
+        fills = {category: draw._getink(f'{color}{style.fill_intensity:02X}')[0] for category, color in colors.items()}
+        for box, category in compress(zip(box_list, category_list), detailed.tolist()):
+            rectangle(box, fills[category], 1)
+        for box, category in compress(zip(box_list, category_list), outlined.tolist()):
+            rectangle(box, inks[category], 0, style.line_width)
+        primitives += int(detailed.sum() + outlined.sum())
+
+        size = style.marker_size
+        corners = boxes[:, [2, 1]]
+        for x, y in corners[false_negative & detailed].tolist():
+            draw.circle((x, y), size, fill='black')
+        # Draw a cross in upper right corner of false positives
+        red = draw._getink('red')[0]
+        crosses = np.concatenate([corners - size, corners + size], axis=1)[false_positive & detailed]
+        for x1, y1, x2, y2 in crosses.tolist():
+            draw.draw.draw_lines((x1, y1, x2, y2), red, 2)
+            draw.draw.draw_lines((x1, y2, x2, y1), red, 2)
+        primitives += int((false_negative & detailed).sum() + 2 * len(crosses))
+
+        if labels is not None:
+            full = levels == LODPolicy.FULL
+            positions = boxes[full, :2] - style.font_size // 2
+            draw_labels(draw, positions, np.asarray(labels, dtype=object)[full].tolist(), style.font_size)
+            primitives += int(full.sum())
+
+    dense = levels == LODPolicy.DENSITY
+    if dense.any():
+        primitives += draw_density(draw, boxes[dense], categories[dense], colors, style.lod.density_cell, origin)
+    return primitives
+
+
+def draw_density(draw, boxes, categories, colors, cell, origin=(0, 0)):
+    '''
+    Collapse boxes into one glyph per canvas cell, a square whose opacity grows with the number
+    of boxes in the cell and colored as the category of the first of them. Returns the number of glyphs.
+    '''
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2 + origin
+    cells = np.floor(centers / cell).astype(np.int64)
+    cells, first, counts = np.unique(cells, axis=0, return_index=True, return_counts=True)
+    alphas = np.minimum(255, 80 + 35 * counts)
+    corners = cells * cell - origin
+    for (x, y), alpha, category in zip(corners.tolist(), alphas.tolist(), categories[first].tolist()):
+        draw.rectangle((x + 1, y + 1, x + cell - 2, y + cell - 2), fill=f'{colors[category]}{alpha:02X}')
+    return len(cells)
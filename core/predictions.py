@@ -0,0 +1,208 @@
+import os
+from threading import Lock
+import numpy as np
+
+
+def parse_predictions(text):
+    '''
+    Parse the text of a YOLO predictions file into an (N, 6) array with rows
+    (category, x1, y1, x2, y2, confidence). Rows may have 5 or 6 columns, the confidence
+    of rows without it is NaN. Blank lines are skipped.
+    '''
+    data = np.frombuffer(text.encode(), dtype=np.uint8)
+    # Columns per line from the starts of the tokens, in one pass over the bytes. Control
+    # characters are separators, like for str.split, or make the parse fail.
+    space = data <= 32
+    first = ~space
+    first[1:] &= space[:-1]
+    line = np.searchsorted(np.flatnonzero(data == 10), np.flatnonzero(first))
+    widths = np.bincount(line, minlength=1)
+    bad = np.flatnonzero((widths != 0) & (widths != 5) & (widths != 6))
+    if len(bad):
+        raise ValueError(f"Line {bad[0] + 1} has {widths[bad[0]]} columns, expected 5 or 6")
+    widths = widths[widths > 0]
+    if len(widths) == 0:
+        return np.empty((0, 6))
+    values = np.array(text.split(), dtype=np.float64)
+    if len(values) != widths.sum():
+        raise ValueError("Unexpected whitespace between the columns")
+
+    if (widths == 6).all():
+        rows = values.reshape(-1, 6)
+    elif (widths == 5).all():
+        rows = np.column_stack([values.reshape(-1, 5), np.full(len(widths), np.nan)])
+    else:
+        # Mixed widths, gather each kind of row from its offsets
+        starts = np.cumsum(widths) - widths
+        rows = np.full((len(widths), 6), np.nan)
+        for width in (5, 6):
+            mask = widths == width
+            rows[mask, :width] = values[starts[mask][:, None] + np.arange(width)]
+
+    cat, x, y, w, h, conf = rows.T
+    return np.column_stack([cat, x - w / 2, y - h / 2, x + w / 2, y + h / 2, conf])
+
+
+def read_predictions(path):
+    '''
+    Read a YOLO predictions file into an (N, 6) array with rows
+    (category, x1, y1, x2, y2, confidence).
+    '''
+    with open(path, 'r') as f:
+        return parse_predictions(f.read())
+
+
+class PredictionsCache:
+    """
+    Parsed predictions of all the files of a folder packed in a few binary segments, so that
+    reopening a dataset reads memory-mapped arrays instead of parsing every file. Entries are
+    invalidated by the modification time and size of their file. New parses are kept in memory
+    until `save`, which runs by itself every `flush_every` new parses so they stay bounded.
+    With a `memory` LRUCache, the arrays read recently are kept there within its byte budget.
+
+    The cache is a directory with `index.npz` (names, mtimes, sizes, segments and row offsets)
+    and one `rows_<segment>.npy` per save with the rows of its new parses, concatenated. The
+    segments are merged into one when there are more than `max_segments`. Caches written with
+    another `version` of the parser are ignored.
+    """
+    version = 3
+
+    def __init__(self, folder, cache_folder, memory=None, flush_every=1000, max_segments=16):
+        self.folder = folder
+        self.cache_folder = cache_folder
+        self.memory = memory
+        self.flush_every = flush_every
+        self.max_segments = max_segments
+        self.lock = Lock()
+        self.entries = {}
+        self.segments = []
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def segment_path(self, segment):
+        return os.path.join(self.cache_folder, f'rows_{segment}.npy')
+
+    def load(self):
+        try:
+            with np.load(os.path.join(self.cache_folder, 'index.npz')) as index:
+                if 'version' not in index.files or int(index['version']) != self.version:
+                    return
+                names, mtimes, sizes = index['names'], index['mtimes'], index['sizes']
+                segments, starts, ends, lengths = index['segments'], index['starts'], index['ends'], index['lengths']
+            # Empty arrays can't be memory-mapped
+            rows = [np.load(self.segment_path(i), mmap_mode='r' if n else None) for i, n in enumerate(lengths.tolist())]
+        except (OSError, ValueError, KeyError):
+            return
+        if [len(r) for r in rows] != lengths.tolist():
+            # Interrupted save, the index and the rows do not match
+            return
+        self.segments = rows
+        self.entries = {
+            name: (mtime, size, segment, start, end)
+            for name, mtime, size, segment, start, end in zip(
+                names.tolist(), mtimes.tolist(), sizes.tolist(), segments.tolist(), starts.tolist(), ends.tolist(),
+            )
+        }
+
+    def read(self, name, keep=True, remember=True):
+        '''
+        Predictions of a file of the folder, empty if the file does not exist. Without `keep`,
+        new parses are not kept for the next save, for readers that never save. Without
+        `remember` they are not put in `memory`, for bulk reads that would evict the hot ones.
+        '''
+        path = os.path.join(self.folder, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return np.empty((0, 6))
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = ('predictions', path, stamp)
+        if self.memory is not None:
+            predictions = self.memory.get(key)
+            if predictions is not None:
+                return predictions.copy()
+
+        predictions = None
+        with self.lock:
+            entry = self.pending.get(name)
+            if entry is not None and entry[0] == stamp:
+                predictions = entry[1]
+            else:
+                entry = self.entries.get(name)
+                if entry is not None and entry[:2] == stamp:
+                    predictions = np.array(self.segments[entry[2]][entry[3]:entry[4]])
+            if predictions is not None:
+                self.hits += 1
+
+        flush = False
+        if predictions is None:
+            predictions = read_predictions(path)
+            with self.lock:
+                self.misses += 1
+                if keep:
+                    self.pending[name] = (stamp, predictions)
+                    flush = len(self.pending) >= self.flush_every
+        if self.memory is not None and remember:
+            self.memory.put(key, predictions)
+        if flush:
+            self.save()
+        return predictions.copy()
+
+    def save(self):
+        '''Write the new parses as a new segment, if there are any'''
+        with self.lock:
+            if not self.pending:
+                return
+            names = sorted(self.pending)
+            arrays = [self.pending[name][1] for name in names]
+            offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64)
+            entries = dict(self.entries)
+            for i, name in enumerate(names):
+                entries[name] = (*self.pending[name][0], len(self.segments), int(offsets[i]), int(offsets[i + 1]))
+            segments = self.segments + [np.concatenate(arrays) if arrays else np.empty((0, 6))]
+
+            os.makedirs(self.cache_folder, exist_ok=True)
+            merged = len(segments) > self.max_segments
+            if merged:
+                stale = len(segments)
+                segments, entries = self._merge(segments, entries)
+            else:
+                self._write_segment(len(segments) - 1, segments[-1])
+            self._write_index(entries, segments)
+            self.segments, self.entries = segments, entries
+            self.pending = {}
+            if merged:
+                for segment in range(1, stale):
+                    try:
+                        os.remove(self.segment_path(segment))
+                    except OSError:
+                        pass
+
+    def _merge(self, segments, entries):
+        '''Pack the rows of all the entries into a single segment, dropping the stale ones'''
+        names = sorted(entries)
+        arrays = [np.asarray(segments[entries[name][2]][entries[name][3]:entries[name][4]]) for name in names]
+        offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64)
+        rows = np.concatenate(arrays) if arrays else np.empty((0, 6))
+        # Release the memory maps before replacing their files
+        self.segments = []
+        segments = [rows]
+        self._write_segment(0, rows)
+        return segments, {name: (*entries[name][:2], 0, int(offsets[i]), int(offsets[i + 1])) for i, name in enumerate(names)}
+
+    def _write_segment(self, segment, rows):
+        tmp = os.path.join(self.cache_folder, 'rows.tmp.npy')
+        np.save(tmp, rows)
+        os.replace(tmp, self.segment_path(segment))
+
+    def _write_index(self, entries, segments):
+        names = list(entries)
+        columns = np.array([entries[name] for name in names], dtype=np.int64).reshape(-1, 5)
+        tmp = os.path.join(self.cache_folder, 'index.tmp.npz')
+        np.savez(
+            tmp, version=self.version, names=np.array(names, dtype=str), mtimes=columns[:, 0], sizes=columns[:, 1],
+            segments=columns[:, 2], starts=columns[:, 3], ends=columns[:, 4], lengths=np.array([len(r) for r in segments], dtype=np.int64),
+        )
+        os.replace(tmp, os.path.join(self.cache_folder, 'index.npz'))
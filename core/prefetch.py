@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Loads the items around the current position of a sequence in a thread pool, so
+    they are ready by the time they are requested. More items are loaded in the
+    direction of navigation (`ahead`) than in the opposite one (`behind`).
+    """
+    def __init__(self, load, ahead=3, behind=1, max_workers=2):
+        self.load = load
+        self.ahead = ahead
+        self.behind = behind
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        self.futures = {}
+        self.last_index = None
+        self.direction = 1
+
+    def take(self, key):
+        '''Get a future of the item, reusing the prefetched one if there is any'''
+        future = self.futures.pop(key, None)
+        if future is None or future.cancelled() or (future.done() and future.exception() is not None):
+            future = self.executor.submit(self.load, key)
+        return future
+
+    def schedule(self, keys):
+        '''Load the given keys in the background and cancel anything else that is still pending'''
+        keys = list(dict.fromkeys(keys))
+        for key in list(self.futures):
+            if key not in keys:
+                # Running tasks can't be interrupted, their results are just discarded
+                self.futures.pop(key).cancel()
+        for key in keys:
+            if key not in self.futures:
+                self.futures[key] = self.executor.submit(self.load, key)
+
+    def navigate(self, items, index):
+        '''Prefetch the neighbours of items[index] according to the direction of navigation'''
+        if self.last_index is not None and index != self.last_index:
+            self.direction = 1 if index > self.last_index else -1
+        self.last_index = index
+
+        forward = self.ahead if self.direction > 0 else self.behind
+        backward = self.behind if self.direction > 0 else self.ahead
+        after = [items[i] for i in range(index + 1, min(index + 1 + forward, len(items)))]
+        before = [items[i] for i in range(index - 1, max(index - 1 - backward, -1), -1)]
+        # Items in the direction of navigation are submitted first
+        self.schedule(after + before if self.direction > 0 else before + after)
+
+    def clear(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.last_index = None
+
+    def shutdown(self):
+        self.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
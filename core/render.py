@@ -0,0 +1,87 @@
+import math
+import numpy as np
+from PIL import Image
+from core.overlay import AnnotationOverlay
+
+
+def is_axis_aligned(affine, eps=1e-9):
+    '''Check if the affine only scales and translates (no rotation or shear)'''
+    return abs(affine[0, 1]) < eps and abs(affine[1, 0]) < eps and affine[0, 0] > 0 and affine[1, 1] > 0
+
+
+def render_affine(image, affine, size, resample=Image.BILINEAR):
+    '''Render the image on a canvas of the given size with a general affine transform'''
+    mat_inv = np.linalg.inv(affine)
+
+    affine_inv = (
+        mat_inv[0, 0], mat_inv[0, 1], mat_inv[0, 2],
+        mat_inv[1, 0], mat_inv[1, 1], mat_inv[1, 2]
+    )
+
+    return image.transform(size, Image.AFFINE, affine_inv, resample)
+
+
+def render_axis_aligned(image, affine, size, resample=Image.BILINEAR):
+    '''
+    Render the image on a canvas of the given size when the affine is only scale plus
+    translate. Only the visible source rectangle is resized, so the cost depends on the
+    canvas size and not on the image size.
+    '''
+    width, height = size
+    sx, tx = affine[0, 0], affine[0, 2]
+    sy, ty = affine[1, 1], affine[1, 2]
+
+    # Canvas pixels covered by the image
+    dx1 = max(0, math.floor(tx))
+    dy1 = max(0, math.floor(ty))
+    dx2 = min(width, math.ceil(tx + sx * image.width))
+    dy2 = min(height, math.ceil(ty + sy * image.height))
+
+    if dx2 <= dx1 or dy2 <= dy1:
+        return Image.new(image.mode, size)
+
+    # Source rectangle that maps onto them, clamped to the image bounds
+    box = (
+        max(0.0, (dx1 - tx) / sx),
+        max(0.0, (dy1 - ty) / sy),
+        min(float(image.width), (dx2 - tx) / sx),
+        min(float(image.height), (dy2 - ty) / sy),
+    )
+
+    view = image.resize((dx2 - dx1, dy2 - dy1), resample, box=box)
+    if view.size == tuple(size):
+        return view
+
+    dst = Image.new(view.mode, size)
+    dst.paste(view, (dx1, dy1))
+    return dst
+
+
+def render_view(image, affine, size, resample=Image.BILINEAR):
+    '''Render the image as seen through the affine (image -> canvas) on a canvas of the given size'''
+    size = (int(size[0]), int(size[1]))
+    if is_axis_aligned(affine):
+        return render_axis_aligned(image, affine, size, resample)
+    return render_affine(image, affine, size, resample)
+
+
+def fitted_size(image_size, max_size):
+    '''Size of an image scaled down (or up) to fit in max_size, keeping its aspect ratio'''
+    scale = min(max_size[0] / image_size[0], max_size[1] / image_size[1])
+    return max(1, round(image_size[0] * scale)), max(1, round(image_size[1] * scale))
+
+
+def render_annotated(image, annotations, max_size, style, full_size=None):
+    '''
+    RGB image fitted in max_size with the annotations (a list or an AnnotationStore) drawn on
+    top, the same way the labeling page draws them but without any widget. `full_size` is the
+    size the boxes refer to when `image` is a reduced draft of it.
+    '''
+    full_size = full_size or image.size
+    size = fitted_size(full_size, max_size)
+    affine = np.diag([size[0] / full_size[0], size[1] / full_size[1], 1.0])
+    view = image.convert('RGB').resize(size, Image.BILINEAR)
+    if len(annotations) == 0:
+        return view
+    overlay = AnnotationOverlay().render(annotations, affine, size, style)
+    return Image.alpha_composite(view.convert('RGBA'), overlay).convert('RGB')
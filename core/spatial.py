@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class GridIndex:
+    """
+    Uniform grid over (N, 4) xyxy boxes. Every box is registered in the cells it overlaps,
+    so rectangle and point queries only look at the boxes of the cells they touch.
+    """
+    def __init__(self, boxes, cell_size=None, max_query_cells=4096):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.boxes = np.concatenate([
+            np.minimum(self.boxes[:, :2], self.boxes[:, 2:]),
+            np.maximum(self.boxes[:, :2], self.boxes[:, 2:]),
+        ], axis=1)
+        self.max_query_cells = max_query_cells
+
+        if len(self.boxes) == 0:
+            self.origin = np.zeros(2)
+            self.cell_size = 1.0
+            self.shape = (1, 1)
+            self.starts = np.zeros(2, dtype=np.intp)
+            self.items = np.zeros(0, dtype=np.intp)
+            return
+
+        self.origin = self.boxes[:, :2].min(axis=0)
+        extent = self.boxes[:, 2:].max(axis=0) - self.origin
+        if cell_size is None:
+            sizes = np.maximum(self.boxes[:, 2] - self.boxes[:, 0], self.boxes[:, 3] - self.boxes[:, 1])
+            cell_size = max(float(np.median(sizes)) * 2, float(extent.max()) / 256, 1.0)
+        self.cell_size = cell_size
+        self.shape = tuple(int(n) for n in np.floor(extent / cell_size).astype(int) + 1)
+
+        cells = self.cells_of(self.boxes)
+        spans = (cells[:, 2] - cells[:, 0] + 1) * (cells[:, 3] - cells[:, 1] + 1)
+        box_ids = np.repeat(np.arange(len(self.boxes)), spans)
+
+        # Cell coordinates of every (box, cell) pair
+        offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+        widths = np.repeat(cells[:, 2] - cells[:, 0] + 1, spans)
+        cx = np.repeat(cells[:, 0], spans) + offsets % widths
+        cy = np.repeat(cells[:, 1], spans) + offsets // widths
+        cell_ids = cy * self.shape[0] + cx
+
+        # CSR layout: the boxes of cell c are items[starts[c]:starts[c + 1]]
+        order = np.argsort(cell_ids, kind='stable')
+        self.items = box_ids[order]
+        self.starts = np.searchsorted(cell_ids[order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def cells_of(self, rects):
+        cells = np.floor((np.asarray(rects, dtype=np.float64).reshape(-1, 4) - np.tile(self.origin, 2)) / self.cell_size)
+        cells = cells.astype(np.int64)
+        cells[:, [0, 2]] = np.clip(cells[:, [0, 2]], 0, self.shape[0] - 1)
+        cells[:, [1, 3]] = np.clip(cells[:, [1, 3]], 0, self.shape[1] - 1)
+        return cells
+
+    def query(self, rect):
+        '''Sorted indices of the boxes that intersect the rectangle (x1, y1, x2, y2)'''
+        if len(self.boxes) == 0:
+            return np.zeros(0, dtype=np.intp)
+        x1, y1, x2, y2 = rect
+        cx1, cy1, cx2, cy2 = self.cells_of(rect)[0]
+        n_cells = (cx2 - cx1 + 1) * (cy2 - cy1 + 1)
+
+        if n_cells > self.max_query_cells:
+            candidates = np.arange(len(self.boxes))
+        else:
+            rows = np.arange(cy1, cy2 + 1)[:, None] * self.shape[0] + np.arange(cx1, cx2 + 1)[None, :]
+            rows = rows.ravel()
+            chunks = [self.items[self.starts[c]:self.starts[c + 1]] for c in rows]
+            candidates = np.unique(np.concatenate(chunks)) if chunks else np.zeros(0, dtype=np.intp)
+
+        boxes = self.boxes[candidates]
+        hit = (boxes[:, 0] <= x2) & (boxes[:, 2] >= x1) & (boxes[:, 1] <= y2) & (boxes[:, 3] >= y1)
+        return candidates[hit]
+
+    def query_point(self, x, y):
+        '''Sorted indices of the boxes that contain the point'''
+        return self.query((x, y, x, y))
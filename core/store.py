@@ -0,0 +1,501 @@
+from collections import namedtuple
+import numpy as np
+from PIL import Image, ImageDraw
+from core.overlay import OverlayStyle, draw_boxes, transform_boxes
+
+INSERT, DELETE, UPDATE = 'insert', 'delete', 'update'
+
+AnnotationChange = namedtuple('AnnotationChange', ['kind', 'ids', 'rows', 'fields'])
+
+
+class AnnotationStore:
+    """
+    Struct-of-arrays storage of the annotations of an image: one NumPy column per field
+    instead of one Python object per annotation. Rows are appended in amortized constant
+    time and indexing returns `Annotation` row proxies for code that works per annotation.
+
+    Deleting rows shifts the following ones, so row proxies taken before a deletion must be
+    taken again.
+
+    Every edit made through the store or its proxies is logged as an AnnotationChange with
+    the ids and rows it touched, so views can apply only the changes since the version they
+    last saw. Rows of deletions are the rows before deleting.
+
+    Rows with a confidence below `threshold` are hidden without touching their visible flag.
+    An index of the rows sorted by confidence is built the first time it is needed and
+    dropped when rows or confidences change, so moving the threshold is a binary search and
+    only the rows crossing it are logged as changed.
+    """
+    max_changes = 1024
+
+    def __init__(self, categories=(), image_fn=None, capacity=0):
+        self.categories = list(categories)
+        self.image_fn = image_fn
+        self.size = 0
+        self.next_id = 0
+        self.version = 0
+        self.changes = []
+        self.threshold = None
+        self._order = None
+        self._bbox = np.zeros((capacity, 4), dtype=np.float64)
+        self._category_id = np.zeros(capacity, dtype=np.int32)
+        self._confidence = np.full(capacity, np.nan, dtype=np.float32)
+        self._id = np.zeros(capacity, dtype=np.int64)
+        self._visible = np.ones(capacity, dtype=bool)
+        self._false_positive = np.zeros(capacity, dtype=bool)
+        self._false_negative = np.zeros(capacity, dtype=bool)
+
+    COLUMNS = ('_bbox', '_category_id', '_confidence', '_id', '_visible', '_false_positive', '_false_negative')
+
+    @classmethod
+    def from_predictions(cls, predictions, categories=(), image_fn=None):
+        '''Build the store of an (N, 6) array of (category, x1, y1, x2, y2, confidence) rows'''
+        predictions = np.asarray(predictions, dtype=np.float64).reshape(-1, 6)
+        store = cls(categories, image_fn, capacity=len(predictions))
+        store.size = len(predictions)
+        store.next_id = len(predictions)
+        store._bbox[:] = predictions[:, 1:5]
+        store._category_id[:] = predictions[:, 0].astype(np.int32)
+        store._confidence[:] = predictions[:, 5]
+        store._id[:] = np.arange(len(predictions))
+        return store
+
+    # -------------------------------------------------------------------------------
+    # Columns
+    # -------------------------------------------------------------------------------
+
+    @property
+    def bbox(self):
+        return self._bbox[:self.size]
+
+    @property
+    def category_id(self):
+        return self._category_id[:self.size]
+
+    @property
+    def confidence(self):
+        return self._confidence[:self.size]
+
+    @property
+    def id(self):
+        return self._id[:self.size]
+
+    @property
+    def visible(self):
+        return self._visible[:self.size]
+
+    @property
+    def false_positive(self):
+        return self._false_positive[:self.size]
+
+    @property
+    def false_negative(self):
+        return self._false_negative[:self.size]
+
+    @property
+    def category(self):
+        '''Category names of the rows, as an object array'''
+        ids = self.category_id
+        if len(ids) == 0:
+            return np.zeros(0, dtype=object)
+        names = np.empty(max(len(self.categories), int(ids.max()) + 1), dtype=object)
+        names[:] = list(range(len(names)))
+        names[:len(self.categories)] = self.categories
+        return names[ids]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.COLUMNS)
+
+    def category_name(self, category_id):
+        category_id = int(category_id)
+        return self.categories[category_id] if category_id < len(self.categories) else category_id
+
+    def find_category_id(self, category):
+        '''Id of a category name or id, None for unknown names. Unlike category_id_of, never adds it.'''
+        if category in self.categories:
+            return self.categories.index(category)
+        if isinstance(category, (int, np.integer)):
+            return int(category)
+        return None
+
+    def category_id_of(self, category):
+        category_id = self.find_category_id(category)
+        if category_id is not None:
+            return category_id
+        # New names go after every id in use, the unnamed ids keep themselves as names
+        n = int(self.category_id.max()) + 1 if self.size else 0
+        self.categories.extend(range(len(self.categories), n))
+        self.categories.append(category)
+        return len(self.categories) - 1
+
+    def mask(self, visible=None, category=None, false_positive=None, false_negative=None, min_confidence=None):
+        '''Boolean mask of the rows matching all the given conditions'''
+        mask = np.ones(self.size, dtype=bool)
+        if visible is not None:
+            mask &= self.visible == visible
+        if category is not None:
+            # Unknown names match nothing
+            category_id = self.find_category_id(category)
+            mask &= False if category_id is None else self.category_id == category_id
+        if false_positive is not None:
+            mask &= self.false_positive == false_positive
+        if false_negative is not None:
+            mask &= self.false_negative == false_negative
+        if min_confidence is not None:
+            mask &= self.confidence >= min_confidence
+        return mask
+
+    def confidence_order(self):
+        '''Rows with a confidence sorted by it, and their sorted confidences'''
+        if self._order is None:
+            confidence = self.confidence
+            rows = np.flatnonzero(~np.isnan(confidence))
+            rows = rows[np.argsort(confidence[rows], kind='stable')]
+            self._order = (rows, confidence[rows])
+        return self._order
+
+    def below_threshold(self, threshold=None):
+        '''Rows with a confidence below the threshold, the store threshold by default'''
+        threshold = self.threshold if threshold is None else threshold
+        rows, confidences = self.confidence_order()
+        if threshold is None:
+            return rows[:0]
+        return rows[:np.searchsorted(confidences, threshold)]
+
+    @property
+    def above_threshold(self):
+        '''Mask of the rows that are not below the threshold, rows without confidence always are'''
+        mask = np.ones(self.size, dtype=bool)
+        mask[self.below_threshold()] = False
+        return mask
+
+    def shown(self, rows):
+        '''Whether the given rows are drawn: visible and not below the threshold'''
+        shown = self.visible[rows]
+        if self.threshold is not None:
+            shown &= ~(self.confidence[rows] < self.threshold)
+        return shown
+
+    def count_above(self, threshold=None):
+        return self.size - len(self.below_threshold(threshold))
+
+    def set_threshold(self, threshold):
+        '''Hide the rows with a confidence below the threshold, None shows them all'''
+        rows, confidences = self.confidence_order()
+        old = 0 if self.threshold is None else np.searchsorted(confidences, self.threshold)
+        new = 0 if threshold is None else np.searchsorted(confidences, threshold)
+        self.threshold = threshold
+        if old != new:
+            self.record(UPDATE, rows[min(old, new):max(old, new)], ('threshold',))
+
+    def take(self, rows):
+        '''New store with a copy of the selected rows (indices or boolean mask)'''
+        rows = np.arange(self.size)[rows]
+        store = AnnotationStore(self.categories, self.image_fn, capacity=len(rows))
+        for column in self.COLUMNS:
+            getattr(store, column)[:] = getattr(self, column)[rows]
+        store.size = len(rows)
+        store.next_id = self.next_id
+        store.threshold = self.threshold
+        return store
+
+    # -------------------------------------------------------------------------------
+    # Rows
+    # -------------------------------------------------------------------------------
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, row):
+        if isinstance(row, (int, np.integer)):
+            if row < 0:
+                row += self.size
+            if not 0 <= row < self.size:
+                raise IndexError("annotation index out of range")
+            return Annotation.row_of(self, int(row))
+        return [Annotation.row_of(self, int(ix)) for ix in np.arange(self.size)[row]]
+
+    def __iter__(self):
+        for row in range(self.size):
+            yield Annotation.row_of(self, row)
+
+    def reserve(self, capacity):
+        if capacity <= len(self._id):
+            return
+        capacity = max(capacity, 2 * len(self._id), 16)
+        for column in self.COLUMNS:
+            old = getattr(self, column)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, column, new)
+
+    def append(self, annot=None, bbox=None, category=None, confidence=None, visible=True, false_positive=False, false_negative=False):
+        '''
+        Add a row, either from the fields or copying an annotation. The annotation is then
+        rebound to the new row, so it becomes part of this store. Returns the row.
+        '''
+        if annot is not None:
+            bbox, category, confidence = annot.bbox, annot.category, annot.confidence
+            visible, false_positive, false_negative = annot.visible, annot.false_positive, annot.false_negative
+        if false_positive and false_negative:
+            raise ValueError("Can't mark an annotation as both false positive and false negative")
+
+        self.reserve(self.size + 1)
+        row = self.size
+        self._bbox[row] = bbox
+        self._category_id[row] = self.category_id_of(category)
+        self._confidence[row] = np.nan if confidence is None else confidence
+        self._id[row] = self.next_id
+        self._visible[row] = visible
+        self._false_positive[row] = false_positive
+        self._false_negative[row] = false_negative
+        self.size += 1
+        self.next_id += 1
+        self.record(INSERT, [row])
+
+        if annot is not None:
+            annot.store, annot.row = self, row
+        return row
+
+    def delete(self, rows):
+        '''Delete rows (index, indices or boolean mask), shifting the following ones'''
+        keep = np.ones(self.size, dtype=bool)
+        keep[rows] = False
+        self.record(DELETE, np.flatnonzero(~keep))
+        n = int(keep.sum())
+        for column in self.COLUMNS:
+            values = getattr(self, column)
+            values[:n] = values[:self.size][keep]
+        self.size = n
+
+    def update(self, rows, **fields):
+        '''Set columns (bbox, category, visible, false_positive, false_negative) of rows as one change'''
+        rows = np.arange(self.size)[rows]
+        false_positive = fields.get('false_positive', self.false_positive[rows])
+        false_negative = fields.get('false_negative', self.false_negative[rows])
+        if np.any(np.logical_and(false_positive, false_negative)):
+            raise ValueError("Can't mark an annotation as both false positive and false negative")
+        for name, value in fields.items():
+            if name == 'category':
+                self._category_id[rows] = self.category_id_of(value)
+            else:
+                getattr(self, name)[rows] = value
+        self.record(UPDATE, rows, tuple(fields))
+
+    def record(self, kind, rows, fields=()):
+        rows = np.asarray(rows, dtype=np.intp).reshape(-1)
+        if kind != UPDATE or 'confidence' in fields:
+            self._order = None
+        self.version += 1
+        self.changes.append((self.version, AnnotationChange(kind, self._id[rows].copy(), rows, fields)))
+        del self.changes[:-self.max_changes]
+
+    def changes_since(self, version):
+        '''Changes after the version, or None if some of them are no longer in the log'''
+        if version == self.version:
+            return []
+        if not self.changes or self.changes[0][0] > version + 1:
+            return None
+        return [change for v, change in self.changes if v > version]
+
+    def columns(self):
+        '''Columns used to draw the annotations, see core.overlay.annotation_columns'''
+        return {
+            'bbox': self.bbox,
+            'category': self.category,
+            'visible': self.visible if self.threshold is None else self.visible & self.above_threshold,
+            'false_positive': self.false_positive,
+            'false_negative': self.false_negative,
+        }
+
+    def row_of_id(self, annotation_id):
+        rows = np.flatnonzero(self.id == annotation_id)
+        return int(rows[0]) if len(rows) else None
+
+
+class Annotation:
+    """
+    Row proxy of an AnnotationStore. Creating an annotation directly gives it a store of its
+    own, and appending it to another store moves it there.
+    """
+    __slots__ = ('store', 'row')
+
+    def __init__(self, bbox, category, image_fn=None, id=None, confidence=None, visible=True, false_positive=False, false_negative=False):
+        if false_positive and false_negative:
+            raise ValueError("Can't mark an annotation as both false positive and false negative")
+        store = AnnotationStore(image_fn=image_fn)
+        store.append(
+            bbox=bbox,
+            category=category,
+            confidence=confidence,
+            visible=visible,
+            false_positive=false_positive,
+            false_negative=false_negative,
+        )
+        if id is not None:
+            store._id[0] = id
+        self.store = store
+        self.row = 0
+
+    @classmethod
+    def row_of(cls, store, row):
+        annot = cls.__new__(cls)
+        annot.store = store
+        annot.row = row
+        return annot
+
+    def __eq__(self, other):
+        return isinstance(other, Annotation) and self.store is other.store and self.row == other.row
+
+    def __hash__(self):
+        return hash((id(self.store), self.row))
+
+    def __repr__(self):
+        return f"Annotation({self.bbox}, {self.category!r}, id={self.id})"
+
+    @property
+    def image_fn(self):
+        return self.store.image_fn
+
+    @property
+    def bbox(self):
+        return tuple(self.store._bbox[self.row].tolist())
+
+    @bbox.setter
+    def bbox(self, bbox):
+        self.store._bbox[self.row] = bbox
+        self.store.record(UPDATE, [self.row], ('bbox',))
+
+    @property
+    def category(self):
+        return self.store.category_name(self.store._category_id[self.row])
+
+    @category.setter
+    def category(self, category):
+        self.store._category_id[self.row] = self.store.category_id_of(category)
+        self.store.record(UPDATE, [self.row], ('category',))
+
+    @property
+    def id(self):
+        return int(self.store._id[self.row])
+
+    @property
+    def confidence(self):
+        confidence = self.store._confidence[self.row]
+        return None if np.isnan(confidence) else float(confidence)
+
+    @property
+    def visible(self):
+        return bool(self.store._visible[self.row])
+
+    @visible.setter
+    def visible(self, visible):
+        self.store._visible[self.row] = visible
+        self.store.record(UPDATE, [self.row], ('visible',))
+
+    @property
+    def false_positive(self):
+        return bool(self.store._false_positive[self.row])
+
+    @false_positive.setter
+    def false_positive(self, false_positive):
+        self.store._false_positive[self.row] = false_positive
+        self.store.record(UPDATE, [self.row], ('false_positive',))
+
+    @property
+    def false_negative(self):
+        return bool(self.store._false_negative[self.row])
+
+    @false_negative.setter
+    def false_negative(self, false_negative):
+        self.store._false_negative[self.row] = false_negative
+        self.store.record(UPDATE, [self.row], ('false_negative',))
+
+
+    def to_dict(self):
+        return {
+            "image_fn": self.image_fn,
+            "x1": self.bbox[0],
+            "y1": self.bbox[1],
+            "x2": self.bbox[2],
+            "y2": self.bbox[3],
+            "category": self.category,
+            "id": self.id,
+            "confidence": self.confidence,
+            "visible": self.visible,
+            "false_positive": self.false_positive,
+            "false_negative": self.false_negative,
+        }
+
+    @property
+    def x1(self):
+        return self.bbox[0]
+
+    @property
+    def y1(self):
+        return self.bbox[1]
+
+    @property
+    def x2(self):
+        return self.bbox[2]
+
+    @property
+    def y2(self):
+        return self.bbox[3]
+
+    @property
+    def width(self):
+        return self.bbox[2] - self.bbox[0]
+
+    @property
+    def height(self):
+        return self.bbox[3] - self.bbox[1]
+
+    @property
+    def xyxy(self):
+        return self.bbox
+
+    @property
+    def xywh(self):
+        return ((self.x1 + self.x2) / 2, (self.y1 + self.y2) / 2, self.width, self.height)
+
+    def show(self):
+        self.visible = True
+
+    def hide(self):
+        self.visible = False
+
+    def toggle(self):
+        self.visible = not self.visible
+
+    def set_false_positive(self):
+        if self.false_negative:
+            raise ValueError("Can't mark an added annotation as false positive")
+        else:
+            self.false_positive = True
+
+    def draw(self, image=None, canvas_size=None, affine=None, scale=1, color="#00ff00", text=None, fill_intensity=50):
+        if image is None and canvas_size is None:
+            raise ValueError("Either 'image' or 'canvas_size' must be provided")
+        elif image is None:
+            overlay = Image.new('RGBA', canvas_size, (0, 0, 0, 0))
+        else:
+            overlay = image.copy()
+
+        box = np.asarray(self.bbox, dtype=np.float64).reshape(1, 4)
+        if affine is not None:
+            box = transform_boxes(box, affine)
+
+        style = OverlayStyle(default_color=color, fill_intensity=fill_intensity, scale=scale)
+        draw_boxes(
+            ImageDraw.Draw(overlay),
+            np.rint(box),
+            [self.category],
+            np.array([self.false_positive]),
+            np.array([self.false_negative]),
+            None if text is None else [str(text)],
+            style,
+        )
+
+        return overlay
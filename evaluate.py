@@ -0,0 +1,49 @@
+import os
+import sys
+import argparse
+
+from core.batch import dataset_config
+from core.database import AnnotationDatabase, DEFAULT_PATH as DEFAULT_DATABASE_PATH
+from core.evaluation import Evaluator
+from core.journal import journal_path, replay
+from core.manifest import DatasetManifest
+
+
+def print_progress(done, total):
+    sys.stderr.write(f"\rMatched {done}/{total} images ")
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate the predictions of a dataset against its corrected labels")
+    parser.add_argument('dataset', help="Dataset folder, with images, predictions and classes.txt")
+    parser.add_argument('--all', action='store_true', help="Also evaluate the images without corrections, as if their predictions were right")
+    parser.add_argument('--database', default=DEFAULT_DATABASE_PATH,
+                        help="Annotations database with the reviewed images, whose predictions are right if they have no corrections")
+    parser.add_argument('--conf', type=float, help="Confidence threshold of the precision and recall (default: none)")
+    parser.add_argument('--workers', type=int, help="Number of processes (default: number of CPUs)")
+    args = parser.parse_args(argv)
+
+    manifest = DatasetManifest(args.dataset)
+    manifest.scan(details=False)
+    categories, _ = dataset_config(args.dataset)
+    # Corrections of the journal that are not in the corrected label files yet
+    latest, _ = replay(journal_path(args.dataset))
+    reviewed = []
+    if os.path.exists(args.database):
+        database = AnnotationDatabase(args.database)
+        images = database.image_frame(args.dataset)
+        reviewed = images.loc[images['reviewed'], 'image'].tolist()
+        database.close()
+
+    evaluator = Evaluator(args.dataset, workers=args.workers)
+    evaluation = evaluator.evaluate(manifest.names, latest, reviewed, args.all, args.conf, print_progress)
+    evaluator.save()
+    print(f"{evaluation.images} images, {evaluator.computed} matched, the others from the cache")
+    print(evaluation.summary(categories))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import argparse
+
+from core.batch import render_dataset
+
+
+def parse_grid(text):
+    columns, rows = text.lower().split('x')
+    return int(columns), int(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render the images of a dataset with their predictions and corrections, without the app")
+    parser.add_argument('dataset', help="Dataset folder, with images, predictions and classes.txt")
+    parser.add_argument('output', help="Folder for the previews or contact sheets")
+    parser.add_argument('--size', type=int, default=1024, help="Longest side of the previews (default: 1024)")
+    parser.add_argument('--sheet', type=parse_grid, metavar='COLUMNSxROWS', help="Write contact sheets with a grid of previews instead of one file per image")
+    parser.add_argument('--workers', type=int, help="Number of processes (default: number of CPUs)")
+    parser.add_argument('--chunk-size', type=int, default=32, help="Images per task sent to a process (default: 32)")
+    args = parser.parse_args(argv)
+
+    rendered = render_dataset(
+        args.dataset,
+        args.output,
+        max_size=(args.size, args.size),
+        sheet=args.sheet,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+    )
+    print(f"Rendered {rendered} images to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,31 @@
 import os
+import logging
+import numpy as np
 import customtkinter as ctk
 from .objects.image import AnnotatedImage
-from .objects.annotations import AnnotationListbox
+from .objects.annotations import VirtualAnnotationListbox, annotations_from_predictions
+from core.prefetch import Prefetcher
+from core.loader import LatestLoader, open_draft
+from core.cache import LRUCache, file_key
+from core.pyramid import ImagePyramid
+from core.predictions import PredictionsCache
+from core.manifest import DatasetManifest
+from core.store import AnnotationStore
+from core.journal import CorrectionsJournal
+from core.database import AnnotationDatabase, DEFAULT_PATH as DEFAULT_DATABASE_PATH
+from core.filters import DatasetTable, parse_filter
+from PIL import Image
 import json
-from threading import Lock
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
 
+logger = logging.getLogger(__name__)
+
 
 class LabelingPage(ctk.CTkFrame):
 
-    def __init__(self, master, dataset_folder, category_colors=None):
+    def __init__(self, master, dataset_folder, category_colors=None, cache_bytes=1024 * 2**20, database_path=None):
         super().__init__(master)
         
         # IMAGE FRAME
@@ -40,6 +54,13 @@ class LabelingPage(ctk.CTkFrame):
         self.image_name_label = ctk.CTkLabel(self, text="", font=("Roboto", 16))
         self.image_name_label.place(relx=0.38, rely=0.06+relheight, anchor='w')
 
+        self.filter_entry = ctk.CTkEntry(self, placeholder_text="Filter, e.g. drop conf>=0.5 fp unreviewed")
+        self.filter_entry.place(relx=0.86, rely=0.06+relheight, relwidth=0.3, anchor='e')
+        self.filter_entry.bind('<Return>', self.on_filter_entered)
+        # Typing a query must not trigger the shortcuts bound on the window
+        self.filter_entry._entry.bindtags((self.filter_entry._entry, 'Entry', 'all'))
+        self._filter_border_color = self.filter_entry.cget('border_color')
+
         # ANNOTATION FRAME
         self.annotation_frame = ctk.CTkFrame(self, corner_radius=0)
         self.annotation_frame.place(relx=0.99, rely=0.02, relwidth=1-relwidth-0.03, relheight=relheight, anchor='ne')
@@ -54,6 +75,17 @@ class LabelingPage(ctk.CTkFrame):
         self.checkboxes['all'].place(relx=0.02, rely=rely_chk, relheight=chk_h)
         rely_chk += chk_h
 
+        self.threshold_label = ctk.CTkLabel(self.annotation_frame, fg_color="transparent", text="Confidence ≥ 0.00")
+        self.threshold_label.place(relx=0.02, rely=rely_chk, relheight=0.03)
+        rely_chk += 0.03
+        self.threshold_slider = ctk.CTkSlider(self.annotation_frame, from_=0, to=1, number_of_steps=100, command=self.threshold_changed)
+        self.threshold_slider.place(relx=0.02, rely=rely_chk, relwidth=0.96, relheight=0.03)
+        self.threshold_slider.set(0)
+        rely_chk += 0.03
+        self.threshold_counts = ctk.CTkLabel(self.annotation_frame, fg_color="transparent", text="", justify='left')
+        self.threshold_counts.place(relx=0.02, rely=rely_chk, relheight=0.05)
+        rely_chk += 0.05
+
         # self.categories = []
 
         # for category in self.categories:
@@ -77,7 +109,7 @@ class LabelingPage(ctk.CTkFrame):
         self.Label2 = ctk.CTkLabel(self.annotation_frame, fg_color='transparent', text="Annotations")
         self.Label2.place(relx=0.02, rely=rely_chk+0.02, relheight=0.03)
 
-        self.annotation_listbox = AnnotationListbox(self.annotation_frame)
+        self.annotation_listbox = VirtualAnnotationListbox(self.annotation_frame)
         self.annotation_listbox.place(relx=0, rely=0.89, relwidth=1, relheight=0.89-rely_chk-0.05, anchor='sw')
 
         self.category_selector = ctk.CTkComboBox(self.annotation_frame, state='readonly', values=[], command=self.category_selector_changed)
@@ -86,10 +118,37 @@ class LabelingPage(ctk.CTkFrame):
         self.add_button = ctk.CTkButton(self.annotation_frame, text="Add new", command=lambda: self.new_annotation(self.category_selector.get()))
         self.add_button.place(relx=0, rely=0.99, relwidth=1, relheight=0.04, anchor='sw')
 
-        self.lock = Lock()
+        self.cache = LRUCache(cache_bytes)
+        self.prefetcher = Prefetcher(self.read_image, ahead=3, behind=1)
+        self.loader = LatestLoader()
+        self.predictions = None
+        self.journal = None
+        self.database = AnnotationDatabase(database_path or DEFAULT_DATABASE_PATH)
+        self.manifest = None
+        self._manifest_scan = None
+        self._manifest_poll_id = None
+        self._poll_id = None
+        self._draft_generation = None
+        # False while a draft is shown, the annotations of its image are not loaded yet
+        self._annotations_ready = True
+        self._load_error = False
+        self._synced_version = 0
+        self.threshold = None
+        self.table = None
+        self.filter = None
+        self._table_future = None
+        self._table_error = None
+        self._table_updates = []
+        self._table_poll_id = None
 
         self.category_colors = category_colors or {}
         self.images = []
+        self.codes = {}
+        self.sequence = []
+        self.sequence_codes = np.zeros(0, dtype=np.int64)
+        self._names = np.zeros(0, dtype=object)
+        self._sequence_dirty = False
+        self._current_image = None
         self.categories = []
         self.dataset_folder = None
         self.load_dataset(dataset_folder)
@@ -98,16 +157,35 @@ class LabelingPage(ctk.CTkFrame):
         #     checkbox.configure(command=lambda name=name: self.checkbox_changed(name))
         self.create_bindings()
     
+    def destroy(self):
+        if self._poll_id is not None:
+            self.after_cancel(self._poll_id)
+        if self._manifest_poll_id is not None:
+            self.after_cancel(self._manifest_poll_id)
+        if self._table_poll_id is not None:
+            self.after_cancel(self._table_poll_id)
+        if self.manifest is not None:
+            self.manifest.shutdown()
+        self.loader.shutdown()
+        self.prefetcher.shutdown()
+        if self.predictions is not None:
+            self.predictions.save()
+        if self.journal is not None:
+            self.journal.close()
+        self.database.close()
+        super().destroy()
+
     @property
     def current_image(self):
-        return self.images[self.current_index]
+        return self._current_image
     
     @property
     def current_index(self):
+        '''Position of the slider in the sequence of images being navigated'''
         return round(self.slider.get())
     
     def on_resize(self, event=None):
-        # TODO: Filter events that are not resize, because binding is <Configure> and function gets called many times.
+        # <Configure> fires for every widget of the window, the image coalesces the resulting redraws
         width = self.image_frame.winfo_width()
         height = self.image_frame.winfo_height()
         if width != self.image_lbl.width or height != self.image_lbl.height:
@@ -115,6 +193,8 @@ class LabelingPage(ctk.CTkFrame):
     
     def new_annotation(self, category):
         category = self.category_selector_changed(category)
+        if not self._annotations_ready:
+            return
         self.image_lbl.set_annotation_bindings()
         
     def category_selector_changed(self, category=None):
@@ -125,33 +205,102 @@ class LabelingPage(ctk.CTkFrame):
         return category
     
     def on_annotation_change(self, event=None):
-        self.image_lbl.update_annotations(self.annotation_listbox.annotations)
-        self.annotation_listbox.set_annotations(self.image_lbl.annotations)
-        # self.autosave()
+        self.sync_annotations()
+        self.autosave()
+        self.update_threshold_counts()
+
+    def sync_annotations(self):
+        '''Bring the image and the listbox up to date with the edits made since the last change'''
+        annotations = self.image_lbl.annotations
+        if not isinstance(annotations, AnnotationStore):
+            self.image_lbl.update_annotations(self.annotation_listbox.annotations)
+            self.annotation_listbox.set_annotations(self.image_lbl.annotations)
+            return
+        changes = annotations.changes_since(self._synced_version)
+        self._synced_version = annotations.version
+        if changes is None:
+            self.image_lbl.update_annotations(annotations)
+        else:
+            self.image_lbl.apply_changes(changes)
+        self.annotation_listbox.apply_changes(changes)
 
     def on_annotation_finish(self, event=None):
         # TODO: Fix to asjust to new format
+        if not self._annotations_ready:
+            # Drawn on a draft, there is no store to add it to
+            self.image_lbl.update_annotations([])
+            return
         new_annot = self.image_lbl.annotations[-1]
         self.annotation_listbox.insert(new_annot)
-
-        # self.autosave()
+        if isinstance(self.image_lbl.annotations, AnnotationStore):
+            # The image already shows the new annotation
+            self._synced_version = self.image_lbl.annotations.version
+
+        self.autosave()
+
+    def autosave(self):
+        '''Queue the corrections of the current image for the journal, the writing happens in the background'''
+        annotations = self.image_lbl.annotations
+        if isinstance(annotations, AnnotationStore) and annotations.image_fn is not None:
+            if self.journal.record(annotations.image_fn, annotations):
+                self.database.save_image(self.dataset_folder, annotations.image_fn, annotations)
+                self.update_table(lambda table: table.update_image(annotations.image_fn, annotations))
+
+    def threshold_changed(self, value):
+        '''Hide the annotations below the confidence threshold, only the ones crossing it are redrawn'''
+        self.threshold = float(value) if value > 0 else None
+        self.threshold_label.configure(text=f"Confidence ≥ {float(value):.2f}")
+        annotations = self.image_lbl.annotations
+        if isinstance(annotations, AnnotationStore):
+            annotations.set_threshold(self.threshold)
+            self.sync_annotations()
+        self.update_threshold_counts()
+
+    def update_threshold_counts(self):
+        '''Live counts of the boxes shown at the threshold, in the image and in the dataset'''
+        annotations = self.image_lbl.annotations
+        text = ""
+        if isinstance(annotations, AnnotationStore):
+            text = f"Image: {annotations.count_above(self.threshold)}/{len(annotations)}"
+        if self.table is not None:
+            text += f"\nDataset: {self.table.count_above(self.threshold):,}/{self.table.total:,}"
+        self.threshold_counts.configure(text=text)
+
+    def mark_reviewed(self, event=None):
+        if self.current_image is not None:
+            image_fn = self.current_image
+            self.database.set_reviewed(self.dataset_folder, image_fn)
+            self.update_table(lambda table: table.set_reviewed(image_fn))
 
     def on_annotation_selected(self, event=None):
         annot = event.widget.annotation
         x = (annot.x1 + annot.x2) / 2
         y = (annot.y1 + annot.y2) / 2
-        w_scale = self.image_lbl.pil_image.width / (annot.x2 - annot.x1)
-        h_scale = self.image_lbl.pil_image.height / (annot.y2 - annot.y1)
+        w_scale = self.image_lbl.image_width / (annot.x2 - annot.x1)
+        h_scale = self.image_lbl.image_height / (annot.y2 - annot.y1)
         scale = min(w_scale, h_scale) * 3 / 4
 
         self.image_lbl.go_to_point(x, y, scale)
 
+    def on_annotation_clicked(self, event=None):
+        annot = self.image_lbl.clicked_annotation
+        index = self.annotation_listbox.index_of(annot)
+        if index is not None:
+            self.annotation_listbox.select(index)
+
     def load_dataset(self, folder):
         if folder is None:
             return
         self.dataset_folder = folder
         self.images_folder = os.path.join(folder, 'images')
         self.predictions_folder = os.path.join(folder, 'predictions')
+        if self.predictions is not None:
+            self.predictions.save()
+        self.predictions = PredictionsCache(self.predictions_folder, os.path.join(folder, '.cache', 'predictions'), memory=self.cache)
+        if self.journal is not None:
+            self.journal.close()
+        predictions = self.predictions
+        self.journal = CorrectionsJournal(folder, lambda image_fn: predictions.read(os.path.splitext(image_fn)[0] + '.txt'))
         with open(os.path.join(folder, 'classes.txt'), 'r') as f:
             self.categories = [name.strip() for name in f.readlines()]
 
@@ -160,56 +309,289 @@ class LabelingPage(ctk.CTkFrame):
 
         self.category_colors = config.get('category_colors', {})
         self.image_lbl.set_class_colors(self.category_colors)
-        self.images = [fn for fn in os.listdir(self.images_folder) if fn.endswith(('.jpg', '.jpeg', '.png'))]
+        if self.manifest is not None:
+            self.manifest.shutdown()
+        self.manifest = DatasetManifest(folder)
+        if len(self.manifest) == 0:
+            # First time the dataset is opened, list the files now and get the details in the background
+            self.manifest.scan(details=False)
+        self.prefetcher.clear()
+        self.cache.clear()
 
         # TODO: Add checkboxs for visibility according to classes
         self.annotation_listbox.categories = self.categories
         self.annotation_listbox.category_colors = self.category_colors
 
         # self.data.index.name = 'id'
-        self.slider.configure(from_=0, to=len(self.images) - 1, number_of_steps=len(self.images)-1)
-        self.slider.set(0)
-        self.load_image(self.images[0]) # self.current_image
+        self.images = []
+        self._current_image = None
+        self.set_images(self.manifest.names)
         # self.configure_checkboxes()
 
         self.category_selector.configure(values=self.categories)
         self.category_selector.set(self.categories[0])
 
-    def load_image(self, image_fn):
-        if self.lock.locked():
+        self._manifest_scan = self.manifest.rescan()
+        if self._manifest_poll_id is None:
+            self._manifest_poll_id = self.after(200, self.poll_manifest)
+
+    def set_images(self, images):
+        '''Set the list of images, staying on the current image if it is still in the list'''
+        self.images = list(images)
+        self.codes = {name: i for i, name in enumerate(self.images)}
+        self._names = np.array(self.images, dtype=object)
+        # The table of the previous list no longer applies, all the images are navigated until the new one is ready
+        self.table = None
+        self.set_sequence(np.arange(len(self.images)))
+        if self.images:
+            self.load_table()
+
+    def set_sequence(self, codes):
+        '''Navigate the images with the given sorted indices, staying on the current image if it is one of them'''
+        self.assign_sequence(codes)
+        if not self.sequence:
+            self.image_name_label.configure(text=self.image_label_text(self.current_image))
             return
-        
-        with self.lock:
-            annots_fn = os.path.splitext(image_fn)[0] + '.txt'
-            annots_path = os.path.join(self.predictions_folder, annots_fn)
-            if os.path.exists(annots_path):
-                self.annotation_listbox.load_annotations(annots_path, image_fn)
+        position = self.position_of(self.current_image)
+        if position < len(self.sequence) and self.sequence[position] == self.current_image:
+            self.slider.set(position)
+            self.image_name_label.configure(text=self.image_label_text(self.current_image))
+        else:
+            self.slider.set(0)
+            self.load_image(self.sequence[0])
+
+    def assign_sequence(self, codes):
+        self.sequence_codes = np.asarray(codes, dtype=np.int64)
+        self.sequence = self._names[self.sequence_codes].tolist()
+        self._sequence_dirty = False
+        steps = max(1, len(self.sequence) - 1)
+        self.slider.configure(from_=0, to=steps, number_of_steps=steps)
+
+    def position_of(self, image_fn, side='left'):
+        '''Position of an image in the sequence, or where it would be if it is not a match'''
+        return int(np.searchsorted(self.sequence_codes, self.codes.get(image_fn, -1), side=side))
+
+    def refresh_sequence(self):
+        '''Pick up the matches changed by edits since the filter was applied, without leaving the current image'''
+        if not self._sequence_dirty or self.table is None:
+            return
+        self.assign_sequence(self.table.matches)
+        self.slider.set(min(self.position_of(self.current_image), max(0, len(self.sequence) - 1)))
+
+    def image_label_text(self, image_fn):
+        text = image_fn or ""
+        if self._load_error:
+            text += "  (can't be loaded)"
+        if self.filter is not None:
+            if self._table_error is not None:
+                text += "  (filter unavailable)"
+            elif self.table is None:
+                text += "  (filtering...)"
             else:
-                self.annotation_listbox.delete("all")
+                text += f"  ({len(self.sequence)} matches)"
+        return text
+
+    # -------------------------------------------------------------------------------
+    # Filtering
+    # -------------------------------------------------------------------------------
+
+    def load_table(self):
+        '''
+        Build the dataset table for filtering in the database thread, after importing the predictions
+        and corrections of the images that are not in the database yet or whose predictions changed
+        (only slow the first time a dataset is opened)
+        '''
+        folder, names = self.dataset_folder, list(self.images)
+        entries = self.manifest.entries
+        stamps = {name: (entries[name].prediction_mtime, entries[name].prediction_size) for name in names if name in entries}
+        predictions = self.predictions
+        # The whole dataset is read, so its predictions are not put in the memory cache
+        load_predictions = lambda image_fn: predictions.read(os.path.splitext(image_fn)[0] + '.txt', remember=False)
+        self.database.submit(self.database.import_predictions, folder, names, load_predictions, self.journal.corrections, stamps)
+        self._table_future = self.database.submit(DatasetTable.from_database, self.database, folder, names)
+        self._table_error = None
+        self._table_updates = []
+        if self._table_poll_id is None:
+            self._table_poll_id = self.after(200, self.poll_table)
+
+    def poll_table(self):
+        self._table_poll_id = None
+        future = self._table_future
+        if future is None:
+            return
+        if not future.done():
+            self._table_poll_id = self.after(200, self.poll_table)
+            return
+        self._table_future = None
+        if future.exception() is not None:
+            self._table_error = future.exception()
+            self.image_name_label.configure(text=self.image_label_text(self.current_image))
+            return
+        table = future.result()
+        # Edits made while it was built
+        for update in self._table_updates:
+            update(table)
+        self._table_updates = []
+        self.table = table
+        self.set_filter(self.filter)
+        self.update_threshold_counts()
+
+    def update_table(self, update):
+        '''Apply an update to the table, or keep it for the table being built'''
+        if self.table is not None:
+            update(self.table)
+            self._sequence_dirty = self.filter is not None
+        elif self._table_future is not None:
+            self._table_updates.append(update)
+
+    def set_filter(self, conditions):
+        '''Navigate only the images matching an AnnotationFilter, or all of them with None'''
+        self.filter = conditions
+        if self.table is not None:
+            self.set_sequence(self.table.apply(conditions))
+        elif conditions is None:
+            self.set_sequence(np.arange(len(self.images)))
+        else:
+            # Applied when the table is ready
+            self.image_name_label.configure(text=self.image_label_text(self.current_image))
+
+    def on_filter_entered(self, event=None):
+        try:
+            conditions = parse_filter(self.filter_entry.get(), self.categories)
+        except ValueError:
+            self.filter_entry.configure(border_color='red')
+            return
+        self.filter_entry.configure(border_color=self._filter_border_color)
+        self.set_filter(conditions)
+        self.focus_set()
+
+    def poll_manifest(self):
+        '''Pick up the changes found by the background rescan of the manifest'''
+        self._manifest_poll_id = None
+        if not self._manifest_scan.done():
+            self._manifest_poll_id = self.after(200, self.poll_manifest)
+        elif not self._manifest_scan.cancelled() and self._manifest_scan.exception() is None:
+            if self.manifest.names != self.images:
+                self.set_images(self.manifest.names)
+
+    @staticmethod
+    def decode_image(path, size):
+        '''Decode the image with the pyramid levels needed to show it fitted in `size`'''
+        image = Image.open(path)
+        image.load()
+        return ImagePyramid(image).prebuild(size)
+
+    def read_image(self, image_fn):
+        '''Decode the image and parse its predictions through the cache. Runs in the prefetcher threads.'''
+        image_path = os.path.join(self.images_folder, image_fn)
+        size = (self.image_lbl.width, self.image_lbl.height)
+        pyramid = self.cache.get_or_load(file_key(image_path), lambda: self.decode_image(image_path, size))
+
+        annots_fn = os.path.splitext(image_fn)[0] + '.txt'
+        predictions = self.predictions.read(annots_fn)
+
+        # Annotations are editable, so they are built fresh from the cached predictions
+        annotations = annotations_from_predictions(predictions, self.categories, image_fn)
+        self.journal.apply(image_fn, annotations, predictions)
+        return pyramid, annotations
 
-            label = image_fn
-            # if image is already labeled/corrected:
-            #     label += " (corrected)"
-            self.image_name_label.configure(text=label)
-            self.image_lbl.set_image(os.path.join(self.images_folder, image_fn))
-            self.image_lbl.update_annotations(self.annotation_listbox.annotations)
+    def load_image(self, image_fn):
+        '''
+        Load the image without blocking. If it was not prefetched, a reduced JPEG draft fitted
+        to the window is shown first and replaced by the full decode when it is ready. Newer
+        calls supersede the ones still loading.
+        '''
+        self._current_image = image_fn
+        self._load_error = False
+        label = self.image_label_text(image_fn)
+        # if image is already labeled/corrected:
+        #     label += " (corrected)"
+        self.image_name_label.configure(text=label)
+
+        full = self.prefetcher.take(image_fn)
+        if full.done():
+            # Already decoded, just swap it in
+            self.loader.request(full=full)
+            self.poll_loading()
+        else:
+            image_path = os.path.join(self.images_folder, image_fn)
+            size = (self.image_lbl.width, self.image_lbl.height)
+            self.loader.request(full=full, draft=lambda: open_draft(image_path, size))
+            if self._poll_id is None:
+                self._poll_id = self.after(10, self.poll_loading)
+
+        self.prefetcher.navigate(self.sequence, self.current_index)
+
+    def poll_loading(self):
+        '''Show the stages of the latest load request as they finish'''
+        self._poll_id = None
+        finished = self.loader.poll()
+        if 'full' in finished:
+            self.loader.cancel()
+            try:
+                pyramid, annotations = finished['full'].result()
+            except Exception:
+                logger.exception("Can't load %s", self._current_image)
+                self.show_load_error()
+            else:
+                self.show_loaded(pyramid, annotations)
+        elif 'draft' in finished and finished['draft'].exception() is None:
+            draft = finished['draft'].result()
+            if draft is not None:
+                self.show_draft(*draft)
+
+        if not self.loader.done() and self._poll_id is None:
+            self._poll_id = self.after(10, self.poll_loading)
+
+    def show_draft(self, draft, full_size):
+        self._draft_generation = self.loader.generation
+        self._annotations_ready = False
+        # Drop the previous image's store so nothing can be added to it
+        self.annotation_listbox.set_annotations([])
+        self.image_lbl.annotations = []
+        self.image_lbl.reset_bindings()
+        self.image_lbl.set_image(pil_image=draft, size=full_size)
+
+    def show_load_error(self):
+        '''Blank the image when it or its predictions can't be read, it can't be edited'''
+        self._load_error = True
+        self._annotations_ready = False
+        self.annotation_listbox.set_annotations([])
+        self.image_lbl.annotations = []
+        self.image_lbl.reset_bindings()
+        self.image_lbl.set_image(pil_image=Image.new('RGB', (self.image_lbl.width, self.image_lbl.height), 'gray'))
+        self.image_name_label.configure(text=self.image_label_text(self._current_image))
+
+    def show_loaded(self, pyramid, annotations):
+        generation = self.loader.generation
+        annotations.set_threshold(self.threshold)
+        self.annotation_listbox.set_annotations(annotations)
+        self.image_lbl.annotations = self.annotation_listbox.annotations
+        self._annotations_ready = True
+        self._synced_version = annotations.version
+        self.update_threshold_counts()
+        # Keep the view only when replacing the draft of this same image
+        self.image_lbl.set_image(pyramid=pyramid, keep_view=self._draft_generation == generation)
 
     def slider_changed(self, value):
-        self.load_image(self.images[int(value)])
+        self.refresh_sequence()
+        if self.sequence:
+            self.load_image(self.sequence[min(int(value), len(self.sequence) - 1)])
 
     def prev_image(self):
-        current_index = self.current_index
-        if current_index > 0:
-            self.slider.set(current_index - 1)
-            image = self.images[current_index - 1]
-            self.load_image(image)
+        self.refresh_sequence()
+        # The current image may no longer match after an edit, so look it up rather than using the slider
+        position = self.position_of(self.current_image) - 1
+        if position >= 0:
+            self.slider.set(position)
+            self.load_image(self.sequence[position])
 
     def next_image(self):
-        current_index = self.current_index
-        if current_index < len(self.images) - 1:
-            self.slider.set(current_index + 1)
-            image = self.images[current_index + 1]
-            self.load_image(image)
+        self.refresh_sequence()
+        position = self.position_of(self.current_image, side='right')
+        if position < len(self.sequence):
+            self.slider.set(position)
+            self.load_image(self.sequence[position])
 
     # def configure_checkboxes(self):
     #     for name, checkbox in self.checkboxes.items():
@@ -242,15 +624,17 @@ class LabelingPage(ctk.CTkFrame):
 
     def create_bindings(self):
         self.master.bind('<<AnnotationHover>>', self.image_lbl.on_annotation_hover)
-        self.master.bind("<<AnnotationUnhover>>", lambda e: self.image_lbl.show_image())
+        self.master.bind("<<AnnotationUnhover>>", self.image_lbl.clear_effects)
         self.master.bind("<<AnnotationChanged>>", self.on_annotation_change)
         self.master.bind("<<AnnotationFinished>>", self.on_annotation_finish)
         self.master.bind("<<AnnotationSelected>>", self.on_annotation_selected)
+        self.master.bind("<<AnnotationClicked>>", self.on_annotation_clicked)
         self.master.bind("d", lambda e: self.new_annotation('drop'))
         self.master.bind("e", lambda e: self.new_annotation('elevation'))
         self.master.bind("s", lambda e: self.new_annotation('spatter'))
         self.master.bind("t", lambda e: self.new_annotation('stripe'))
         self.master.bind("b", lambda e: self.new_annotation('bloat'))
+        self.master.bind("r", self.mark_reviewed)
         self.master.bind("<Configure>", self.on_resize)
         self.master.bind("<Left>", lambda e: self.prev_image())
         self.master.bind("<Right>", lambda e: self.next_image())
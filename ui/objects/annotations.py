@@ -1,119 +1,18 @@
 import customtkinter
-from CTkListbox import CTkListbox
-from PIL import Image, ImageDraw
-import numpy as np
 import tkinter as tk
 from functools import wraps
+import numpy as np
+from core.predictions import read_predictions
+from core.store import Annotation, AnnotationStore, UPDATE
 
-class Annotation:
-    def __init__(self, bbox, category, image_fn=None, id=None, confidence=None, visible=True, false_positive=False, false_negative=False):
-        self.image_fn = image_fn
-        self.bbox = bbox
-        self.category = category
-        self.id = id
-        self.confidence = confidence
-        self.visible = visible
-        if false_positive and false_negative:
-            raise ValueError("Can't mark an annotation as both false positive and false negative")
-        self.false_positive = false_positive
-        self.false_negative = false_negative
-
-    def to_dict(self):
-        return {
-            "image_fn": self.image_fn,
-            "x1": self.bbox[0],
-            "y1": self.bbox[1],
-            "x2": self.bbox[2],
-            "y2": self.bbox[3],
-            "category": self.category,
-            "id": self.id,
-            "confidence": self.confidence,
-            "visible": self.visible,
-            "false_positive": self.false_positive,
-            "false_negative": self.false_negative,
-        }
-
-    @property
-    def x1(self):
-        return self.bbox[0]
-
-    @property
-    def y1(self):
-        return self.bbox[1]
-
-    @property
-    def x2(self):
-        return self.bbox[2]
-
-    @property
-    def y2(self):
-        return self.bbox[3]
-    
-    @property
-    def width(self):
-        return self.bbox[2] - self.bbox[0]
-
-    @property
-    def height(self):
-        return self.bbox[3] - self.bbox[1]
-    
-    @property
-    def xyxy(self):
-        return self.bbox
-    
-    @property
-    def xywh(self):
-        return ((self.x1 + self.x2) / 2, (self.y1 + self.y2) / 2, self.width, self.height)
-
-    def show(self):
-        self.visible = True
-
-    def hide(self):
-        self.visible = False
-
-    def toggle(self):
-        self.visible = not self.visible
-
-    def set_false_positive(self):
-        if self.false_negative:
-            raise ValueError("Can't mark an added annotation as false positive")
-        else:
-            self.false_positive = True
-
-    def draw(self, image=None, canvas_size=None, affine=None, scale=1, color="#00ff00", text=None, fill_intensity=50):
-        if image is None and canvas_size is None:
-            raise ValueError("Either 'image' or 'canvas_size' must be provided")
-        elif image is None:
-            overlay = Image.new('RGBA', canvas_size, (0, 0, 0, 0))
-        else:
-            overlay = image.copy()
-
-        draw_im = ImageDraw.Draw(overlay)
-        x1, y1, x2, y2 = self.bbox
-
-        if affine is not None:
-            x1, y1, _ = affine @ np.array([x1, y1, 1])
-            x2, y2, _ = affine @ np.array([x2, y2, 1])
-            
-        width_ = round((3 - scale)/2 + 1) if scale <= 3 else 1
-        draw_im.rectangle((x1, y1, x2, y2), outline=color, width=width_, fill=f'{color}{fill_intensity:02X}')
-
-        # If it is a false positive draw a red cross in upper right corner
-        if self.false_negative:
-            radius = 1 + round(scale) / 2
-            draw_im.circle((x2, y1), radius, fill='black') 
-
-        if self.false_positive:
-            # Draw a cross in upper right corner
-            size = 1 + round(scale) / 2
-            draw_im.line((x2 - size, y1 - size, x2 + size, y1 + size), fill='red', width=2)
-            draw_im.line((x2 - size, y1 + size, x2 + size, y1 - size), fill='red', width=2)
+def annotations_from_predictions(predictions, categories=(), image_fn=None):
+    """Build the annotation store of an (N, 6) predictions array as returned by read_predictions"""
+    return AnnotationStore.from_predictions(predictions, categories, image_fn)
 
-        if text is not None:
-            size = 10 if scale <= 2 else 10 + round((scale - 2) * 2)
-            draw_im.text((x1 - size/2, y1 - size/2), str(text), fill="white", align="center", font_size=size)
 
-        return overlay
+def read_annotations(annotations_path, categories=(), image_fn=None):
+    """Parse a YOLO predictions file into an annotation store"""
+    return annotations_from_predictions(read_predictions(annotations_path), categories, image_fn)
 
 
 def annotation_update(func):
@@ -128,15 +27,29 @@ def annotation_update(func):
 class AnnotationButton(customtkinter.CTkButton):
     def __init__(self, annotation:Annotation, **kwargs):
         self.annotation = annotation
-        self.id = annotation.id
+        self.id = annotation.id if annotation is not None else None
         self.index = kwargs.pop('index')
         self.color = kwargs.get('fg_color', 'transparent')
-        kwargs['fg_color'] = self.color if annotation.visible else 'transparent'
+        if annotation is not None:
+            kwargs['fg_color'] = self.color if annotation.visible else 'transparent'
+            if annotation.false_positive:
+                kwargs['text_color'] = 'red'
+            elif annotation.false_negative:
+                kwargs['text_color'] = 'black'
+        super().__init__(**kwargs)
+
+    def bind_annotation(self, annotation, index, text, color, text_color, border_color=None):
+        '''Show another annotation in the button, so the rows of a virtual list can be recycled'''
+        self.annotation = annotation
+        self.id = annotation.id
+        self.index = index
+        self.color = color
         if annotation.false_positive:
-            kwargs['text_color'] = 'red'
+            text_color = 'red'
         elif annotation.false_negative:
-            kwargs['text_color'] = 'black'
-        super().__init__(**kwargs)
+            text_color = 'black'
+        kwargs = {} if border_color is None else {'border_color': border_color}
+        self.configure(text=text, fg_color=color if annotation.visible else 'transparent', text_color=text_color, **kwargs)
 
     def _on_enter(self, event=None):
         super()._on_enter(event)
@@ -204,176 +117,211 @@ class AnnotationButton(customtkinter.CTkButton):
         else:
             menu.post(self.winfo_rootx() + self.winfo_width(), self.winfo_rooty())
 
-class AnnotationListbox(CTkListbox):
-    def __init__(self, master, **kwargs):
-        self.categories = kwargs.pop('categories', [])
-        self.category_colors = kwargs.pop('category_colors', {})
+class VirtualAnnotationListbox(customtkinter.CTkFrame):
+    """
+    Annotation list that only creates the rows that fit in its height. The rows are a pool of
+    AnnotationButtons that are rebound to the window of annotations on screen when scrolling,
+    so an image with thousands of annotations costs the same as one with a few.
+
+    Annotations below the confidence threshold of the store are not listed. Indices are
+    always rows of the annotations, the window is over the positions of the listed rows.
+    """
+    row_height = 33
+
+    def __init__(
+            self,
+            master,
+            categories=None,
+            category_colors=None,
+            font=None,
+            text_color="default",
+            hover_color="default",
+            highlight_color="default",
+            button_color="default",
+            **kwargs
+        ):
         super().__init__(master, **kwargs)
-        # self.annotations = {}
-    
+        theme = customtkinter.ThemeManager.theme
+        self.categories = categories or []
+        self.category_colors = category_colors or {}
+        self.font = font or customtkinter.CTkFont(theme["CTkFont"]["family"], 13)
+        self.text_color = theme["CTkLabel"]["text_color"] if text_color == "default" else text_color
+        self.hover_color = theme["CTkButton"]["hover_color"] if hover_color == "default" else hover_color
+        self.select_color = theme["CTkButton"]["fg_color"] if highlight_color == "default" else highlight_color
+        self.button_fg_color = "transparent" if button_color == "default" else button_color
+
+        self.store = None
+        self._annotations = []
+        self.first = 0
+        self.selected_index = None
+        self.rows = []
+        self.view = np.zeros(0, dtype=np.intp)
+
+        self.columnconfigure(0, weight=1)
+        self.scrollbar = customtkinter.CTkScrollbar(self, command=self.yview, width=12)
+        self.bind("<Configure>", self.on_resize)
+        self.bind_wheel(self)
+
+    # -------------------------------------------------------------------------------
+    # Rows
+    # -------------------------------------------------------------------------------
+
+    def bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", lambda e: self.scroll(-3 if e.delta > 0 else 3))
+        widget.bind("<Button-4>", lambda e: self.scroll(-3))
+        widget.bind("<Button-5>", lambda e: self.scroll(3))
+
+    def on_resize(self, event=None):
+        '''Grow or shrink the pool of rows to the number that fits in the height'''
+        n = max(1, self.winfo_height() // self.row_height)
+        while len(self.rows) < n:
+            row = AnnotationButton(
+                None,
+                master=self,
+                index=None,
+                text="",
+                anchor="w",
+                text_color=self.text_color,
+                font=self.font,
+                hover_color=self.hover_color,
+                fg_color=self.button_fg_color,
+                border_width=1,
+            )
+            row.configure(command=row.go_to)
+            self.bind_wheel(row)
+            self.rows.append(row)
+        while len(self.rows) > n:
+            self.rows.pop().destroy()
+        self.scrollbar.grid(row=0, column=1, rowspan=n, sticky="ns")
+        self.refresh()
+
+    def row_text(self, annot, index):
+        text = f"{index + 1}: {annot.category}"
+        if annot.confidence is not None:
+            text += f" ({annot.confidence:.2f})"
+        return text
+
+    def update_view(self):
+        if self.store is not None and self.store.threshold is not None:
+            self.view = np.flatnonzero(self.store.above_threshold)
+        else:
+            self.view = np.arange(len(self._annotations))
+
+    def position_of(self, index):
+        '''Position of a row in the list, None if it is not listed'''
+        position = int(np.searchsorted(self.view, index))
+        return position if position < len(self.view) and self.view[position] == index else None
+
+    def refresh(self):
+        '''Rebind the rows to the annotations of the current window'''
+        self.update_view()
+        n = len(self.view)
+        self.first = max(0, min(self.first, n - len(self.rows)))
+        for i in range(len(self.rows)):
+            self.bind_row(i)
+
+        if n > 0:
+            self.scrollbar.set(self.first / n, min(1, (self.first + len(self.rows)) / n))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def bind_row(self, i):
+        row = self.rows[i]
+        if self.first + i >= len(self.view):
+            row.grid_remove()
+            return
+        index = int(self.view[self.first + i])
+        annot = self._annotations[index]
+        color = self.category_colors.get(annot.category, self.button_fg_color)
+        if index == self.selected_index:
+            color = self.select_color
+        row.bind_annotation(annot, index, self.row_text(annot, index), color, self.text_color, self.category_colors.get(annot.category))
+        row.grid(row=i, column=0, padx=0, pady=(0, 5), sticky="ew")
+
+    def apply_changes(self, changes):
+        '''Apply change records of the annotation store, rebinding only the rows on screen they touch'''
+        if changes is None or any(change.kind != UPDATE or 'threshold' in change.fields for change in changes):
+            # Rows were added, removed or crossed the threshold, the whole window may shift
+            self.refresh()
+            return
+        for change in changes:
+            for index in change.rows.tolist():
+                position = self.position_of(index)
+                if position is not None and self.first <= position < self.first + len(self.rows):
+                    self.bind_row(position - self.first)
+
+    def scroll(self, rows):
+        self.first += rows
+        self.refresh()
+
+    def yview(self, *args):
+        '''Scrollbar command'''
+        if args[0] == "moveto":
+            self.first = round(float(args[1]) * len(self.view))
+        elif args[0] == "scroll":
+            step = len(self.rows) if args[2] == "pages" else 1
+            self.first += int(args[1]) * step
+        self.refresh()
+
+    # -------------------------------------------------------------------------------
+    # Annotations
+    # -------------------------------------------------------------------------------
+
     def load_annotations(self, annotations_path, image_fn=None):
-        annotations = []
-        with open(annotations_path, 'r') as f:
-            for line in f:
-                cat, x, y, w, h, conf = [float(x) for x in line.strip().split(' ')]
-                x1 = x - w / 2
-                y1 = y - h / 2
-                x2 = x + w / 2
-                y2 = y + h / 2
-                cat = self.categories[int(cat)] if int(cat) < len(self.categories) else int(cat)
-                annot = Annotation((x1, y1, x2, y2), cat, image_fn=image_fn, confidence=conf)
-                annotations.append(annot)
-
-        self.set_annotations(annotations)
+        self.set_annotations(read_annotations(annotations_path, self.categories, image_fn))
 
     def set_annotations(self, annotations):
-        self.delete("all")
-        for annot in annotations:
-            self.insert(annot, update=False)
-        self.update()
+        if annotations is not self._annotations:
+            # Edits set the same annotations again, keep the scroll and selection for them
+            self.first = 0
+            self.selected_index = None
+        self.store = annotations if isinstance(annotations, AnnotationStore) else None
+        self._annotations = annotations if self.store is not None else list(annotations)
+        self.refresh()
 
     @property
     def annotations(self):
-        return [b.annotation for ix, b in self.buttons.items()]
-    
-    def insert(self, annot, index=None, text=None, color=None, update=True, **args):
-        """add new option in the listbox"""
-
-        if index is None:
-            index = self.end_num 
-            self.end_num += 1
-
-        if text is None:
-            text = f"{index + 1}: {annot.category}"
-            if annot.confidence is not None:
-                text += f" ({annot.confidence:.2f})"
-
-        if color is None:
-            fg_color = self.category_colors.get(annot.category, self.button_fg_color)
-            border_color = self.category_colors.get(annot.category)
-
-        # self.annotations[index] = annot
-        # button = super().insert(index, text, **args)
-        
-        self.buttons[index] = AnnotationButton(
-            annot,
-            master=self,
-            index=index,
-            text=text,
-            anchor=self.justify,
-            text_color=self.text_color,
-            font=self.font,
-            hover_color=self.hover_color,
-            fg_color=fg_color,
-            border_color=border_color,
-            border_width=1,
-            **args,
-        )
-        self.buttons[index].configure(command=lambda num=index: self.buttons[index].go_to())
-        
-        if type(index) is int:
-            self.buttons[index].grid(padx=0, pady=(0, 5), sticky="nsew", column=0, row=index)
-        else:
-            self.buttons[index].grid(padx=0, pady=(0, 5), sticky="nsew", column=0)
-            
+        return self._annotations
+
+    def index_of(self, annot):
+        if self.store is not None:
+            return annot.row if annot.store is self.store else None
+        return self._annotations.index(annot) if annot in self._annotations else None
+
+    def insert(self, annot, update=True):
+        '''Add an annotation at the end, annotations already appended to the store are only shown'''
+        if self.store is None:
+            self._annotations.append(annot)
+        elif annot.store is not self.store:
+            self.store.append(annot)
         if update:
-            self.update()
-
-        if self.multiple:
-            self.buttons[index].bind(
-                "<Shift-1>", lambda e: self.select_multiple(self.buttons[index])
-            )
-
-        return self.buttons[index]
-
-    def toggle_selection(self, index):
-        button = self.buttons[index]
-        if button in self.selections or button == self.selected:
-            self.deselect(index)
-        else:
-            self.select(index)
+            self.refresh()
 
-    def deselect(self, index=None):
-        if not self.multiple:
-            if self.selected:
-                self.selected.configure(fg_color=self.selected.color)
-                self.selected = None
+    def delete(self, index):
+        if str(index).lower() == "all":
+            self.set_annotations([])
             return
-        if self.buttons[index] in self.selections:
-            self.selections.remove(self.buttons[index])
-            self.buttons[index].configure(fg_color=self.buttons[index].color)
-
-    def select(self, index):
-        """select the option"""
-        
-        if isinstance(index, int):
-            if index in self.buttons:
-                selected_button = self.buttons[index]
-            else:
-                selected_button = list(self.buttons.values())[index]
-        else:
-            selected_button = self.buttons[index]
-  
-        if self.multiple:
-            if selected_button in self.selections:
-                self.selections.remove(selected_button)
-                selected_button.configure(fg_color=self.buttons[index].cget('fg_color'), hover=False)
-                self.after(100, lambda: selected_button.configure(hover=self.hover))
-            else:
-                self.selections.append(selected_button)
-            for i in self.selections:
-                i.configure(fg_color=self.select_color, hover=False)
-                self.after(100, lambda button=i: button.configure(hover=self.hover))
+        if self.store is not None:
+            self.store.delete(index)
         else:
-            self.selected = selected_button
-            selected_button.configure(fg_color=self.select_color, hover=False)
-            self.after(100, lambda: selected_button.configure(hover=self.hover))
-
-        if self.command:
-            self.command(self.get())
-
+            del self._annotations[index]
+        if self.selected_index is not None and self.selected_index >= index:
+            self.selected_index = None if self.selected_index == index else self.selected_index - 1
+        self.refresh()
+        self.event_generate("<<AnnotationChanged>>")
 
-    def delete(self, index, last=None):
-        """delete options from the listbox"""
-        if str(index).lower() == "all":
-            self.deactivate("all")
-            for i in self.buttons:
-                self.buttons[i].destroy()
-            self.update()
-            self.buttons = {}
-            self.end_num = 0
-            return
+    def see(self, index):
+        '''Scroll so the row of the annotation at index is visible, if it is listed'''
+        position = self.position_of(index)
+        if position is not None and not self.first <= position < self.first + len(self.rows):
+            self.first = position - len(self.rows) // 2
+            self.refresh()
 
-        if str(index).lower() == "end":
-            self.end_num -= 1
-            if len(self.buttons.keys())>0:
-                index = list(self.buttons.keys())[-1]
-            if index not in self.buttons:
-                return
-        else:
-            if int(index) >= len(self.buttons):
-                return
-            if not last:
-                index = list(self.buttons.keys())[int(index)]
-
-        if last:
-            if str(last).lower() == "end":
-                last = len(self.buttons) - 1
-            elif int(last) >= len(self.buttons):
-                last = len(self.buttons) - 1
-
-            deleted_list = []
-            for i in range(int(index), int(last) + 1):
-                list(self.buttons.values())[i].destroy()
-                deleted_list.append(list(self.buttons.keys())[i])
-                self.update()
-            for i in deleted_list:
-                del self.buttons[i]
-        else:
-            self.buttons[index].destroy()
-            if self.multiple:
-                if self.buttons[index] in self.selections:
-                    self.selections.remove(self.buttons[index])
-            del self.buttons[index]
+    def select(self, index):
+        self.selected_index = index
+        self.see(index)
+        self.refresh()
 
-        self.event_generate("<<AnnotationChanged>>")
+    def deselect(self, index=None):
+        self.selected_index = None
+        self.refresh()
@@ -0,0 +1,46 @@
+import time
+from PIL import ImageTk
+
+
+class PhotoBuffer:
+    """
+    Persistent Tk photo image of a label. Frames are pasted into it in place, straight from the
+    PIL buffer, and a new photo is only allocated when the size of the frames changes.
+    """
+    # Every frame is shown as RGBA, so switching between RGB and RGBA frames keeps the photo
+    MODE = 'RGBA'
+
+    def __init__(self, label):
+        self.label = label
+        self.photo = None
+        self.size = None
+        self.allocations = 0
+        self.uploads = 0
+        self.upload_time = 0.0
+        self.last_upload_time = 0.0
+
+    def show(self, image):
+        '''Upload the frame to Tk, returns the time spent in seconds'''
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert(self.MODE)
+        if self.photo is None or image.size != self.size:
+            self.photo = ImageTk.PhotoImage(self.MODE, image.size, width=image.width, height=image.height)
+            self.size = image.size
+            self.label.configure(image=self.photo)
+            self.allocations += 1
+
+        start = time.perf_counter()
+        # L and RGB frames are converted to RGBA by the paste, straight into the upload buffer
+        self.photo.paste(image)
+        self.last_upload_time = time.perf_counter() - start
+        self.upload_time += self.last_upload_time
+        self.uploads += 1
+        return self.last_upload_time
+
+    def stats(self):
+        return {
+            'allocations': self.allocations,
+            'uploads': self.uploads,
+            'upload_time': self.upload_time,
+            'last_upload_time': self.last_upload_time,
+        }
@@ -1,9 +1,15 @@
 import time
 import customtkinter
-from PIL import Image, ImageDraw
-from customtkinter import CTkImage
+from PIL import Image
 import numpy as np
 from .annotations import Annotation
+from .display import PhotoBuffer
+from core.pyramid import ImagePyramid
+from core.render import render_view
+from core.overlay import AnnotationOverlay, OverlayStyle, LODPolicy, annotation_columns, draw_fill, draw_outline
+from core.effects import EffectsLayer, Effect, crosshair, rectangle
+from core.spatial import GridIndex
+from core.store import INSERT, DELETE
 
 class ZoomableImage(customtkinter.CTkLabel):
     """
@@ -12,13 +18,38 @@ class ZoomableImage(customtkinter.CTkLabel):
     def __init__(self, master=None, **kwargs):
         self.sensibility = kwargs.pop('sensibility', 0.2)
         self.max_zoom = kwargs.pop('max_zoom', 15.0)
+        self.frame_budget = kwargs.pop('frame_budget', 1 / 60)
+        self.resample = kwargs.pop('resample', Image.BILINEAR)
+        self.motion_resample = kwargs.pop('motion_resample', Image.NEAREST)
+        self.motion_level_bias = kwargs.pop('motion_level_bias', 0)
+        self.refine_delay = kwargs.pop('refine_delay', 0.15)
         super().__init__(master, text='', **kwargs)
         self.pil_image = None
+        self.pyramid = None
+        # Last rendered view of the image, reused when only the annotations are redrawn
+        self._base_source = None
+        self._base_key = None
+        self._base = None
         self.__old_event = None
         self.width = kwargs.get('width', 500)
         self.height = kwargs.get('height', 500)
         self.min_scale = 0.0
         self.current_view = None
+        self._press_event = None
+        self.effects = EffectsLayer()
+        # The photo is set on the inner tkinter label, CTkLabel's image handling would
+        # rebuild a PhotoImage for every frame
+        self.display = PhotoBuffer(self._label)
+        self._redraw_id = None
+        self._fit_pending = False
+        self._last_render = 0.0
+        self.frames_rendered = 0
+        self.frames_coalesced = 0
+        self.render_time = 0.0
+        self.last_render_time = 0.0
+        self._animation = None
+        self._animation_id = None
+        self._refine_id = None
         
         self.create_bindings()
         self.reset_transform()
@@ -31,33 +62,56 @@ class ZoomableImage(customtkinter.CTkLabel):
         self.bind("<B2-Motion>", self.mouse_wheel_move)             # MouseDrag
         self.bind("<ButtonRelease-2>", self.mouse_wheel_up)           # MouseUp
 
-    def set_image(self, filename=None, pil_image=None):
-        self.pil_image = pil_image if pil_image else Image.open(filename)
-        self.min_scale = min(self.width / self.pil_image.width, self.height / self.pil_image.height)
-        self.zoom_fit()
+    def set_image(self, filename=None, pil_image=None, size=None, keep_view=False, pyramid=None):
+        '''
+        Set the image to display, or a pyramid of it already built. `size` is the full resolution
+        size when `pil_image` is a reduced preview of it, and `keep_view` keeps the current
+        transform if the size didn't change.
+        '''
+        self.cancel_animation()
+        previous_size = self.pyramid.size if self.pyramid is not None else None
+        if pyramid is None:
+            pyramid = ImagePyramid(pil_image if pil_image else Image.open(filename), size=size)
+        self.pyramid = pyramid
+        self.pil_image = pyramid.base
+        self.min_scale = min(self.width / self.image_width, self.height / self.image_height)
+        if not (keep_view and previous_size == self.pyramid.size):
+            self.zoom_fit()
         self.draw_image(self.pil_image)
 
+    @property
+    def image_width(self):
+        return self.pyramid.size[0] if self.pyramid is not None else self.pil_image.width
+
+    @property
+    def image_height(self):
+        return self.pyramid.size[1] if self.pyramid is not None else self.pil_image.height
+
     def resize_frame(self, width, height):
         self.width = width
         self.height = height
         if self.pil_image is None:
             return
-        self.min_scale = min(self.width / self.pil_image.width, self.height / self.pil_image.height)
-        self.zoom_fit()
-        self.redraw_image()
+        self.min_scale = min(self.width / self.image_width, self.height / self.image_height)
+        # Fitting calls update(), so it is done once when the coalesced frame is rendered
+        self._fit_pending = True
+        self.schedule_redraw()
 
     # -------------------------------------------------------------------------------
     # Mouse events
     # -------------------------------------------------------------------------------
     def mouse_down_left(self, event):
+        self.cancel_animation()
         self.__old_event = event
+        self._press_event = event
 
     def mouse_move_left(self, event):
         if self.pil_image is None:
             return
         
         self.translate(event.x - self.__old_event.x, event.y - self.__old_event.y) if self.__old_event else None
-        self.redraw_image()
+        self.begin_interaction()
+        self.schedule_redraw()
         self.__old_event = event
 
     def mouse_double_click_left(self, event):
@@ -69,6 +123,7 @@ class ZoomableImage(customtkinter.CTkLabel):
     def mouse_wheel(self, event):
         if self.pil_image is None:
             return
+        self.cancel_animation()
 
         if event.delta < 0:
             scaling = 1 / (1 + self.sensibility)
@@ -85,15 +140,13 @@ class ZoomableImage(customtkinter.CTkLabel):
             # Rotate downwards and enlarge
             self.scale_at(scaling, event.x, event.y)
         
-        self.redraw_image()
+        self.begin_interaction()
+        self.schedule_redraw()
 
     def mouse_wheel_move(self, event):
         if self.pil_image is None:
             return
         
-        dst = self.current_view
-        overlay = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 50))
-
         w = event.x - self.__old_event.x
         h = event.y - self.__old_event.y
         # scale = max(abs(w) / self.width, abs(h) / self.height)
@@ -107,10 +160,7 @@ class ZoomableImage(customtkinter.CTkLabel):
         x2 = max(self.__old_event.x, self.__old_event.x + w)
         y2 = max(self.__old_event.y, self.__old_event.y + h)
 
-        draw = ImageDraw.Draw(overlay)
-        draw.rectangle((x1, y1, x2, y2), outline='#ffffff40', fill='#ffffff00', width=2)
-
-        dst = Image.alpha_composite(dst.convert('RGBA'), overlay)
+        dst = self.effects.render(rectangle((x1, y1, x2, y2), '#ffffff40', 2), tint=(0, 0, 0, 50))
 
         self.show_image(dst)
 
@@ -157,8 +207,8 @@ class ZoomableImage(customtkinter.CTkLabel):
         mat[1, 2] = float(offset_y)
         
         scale = self.mat_affine[0, 0]
-        current_h = scale * self.pil_image.height
-        current_w = scale * self.pil_image.width
+        current_h = scale * self.image_height
+        current_w = scale * self.image_width
         self.mat_affine = np.dot(mat, self.mat_affine)
 
         if not zoom:
@@ -199,14 +249,14 @@ class ZoomableImage(customtkinter.CTkLabel):
     def zoom_fit(self):
         self.update()
 
-        if (self.pil_image.width * self.pil_image.height <= 0) or (self.width * self.height <= 0):
+        if (self.image_width * self.image_height <= 0) or (self.width * self.height <= 0):
             return
 
         self.reset_transform()
 
         # Calculate the offsets to center the image
-        offsetx = (self.width - self.pil_image.width * self.min_scale) / 2
-        offsety = (self.height - self.pil_image.height * self.min_scale) / 2
+        offsetx = (self.width - self.image_width * self.min_scale) / 2
+        offsety = (self.height - self.image_height * self.min_scale) / 2
 
         self.scale(self.min_scale)
         self.translate(offsetx, offsety)
@@ -231,9 +281,11 @@ class ZoomableImage(customtkinter.CTkLabel):
             return False
 
         if animate:
+            self.mat_affine = initial_affine
             self.make_animation(final_affine, initial_affine, **kwargs)
-                
-        self.redraw_image()
+        else:
+            self.cancel_animation()
+            self.redraw_image()
         return True
 
 
@@ -243,7 +295,7 @@ class ZoomableImage(customtkinter.CTkLabel):
             return []
         mat_inv = np.linalg.inv(self.mat_affine)
         image_point = np.dot(mat_inv, (x, y, 1.))
-        if image_point[0] < 0 or image_point[1] < 0 or image_point[0] > self.pil_image.width or image_point[1] > self.pil_image.height:
+        if image_point[0] < 0 or image_point[1] < 0 or image_point[0] > self.image_width or image_point[1] > self.image_height:
             return []
         return image_point[:2]
     
@@ -254,22 +306,24 @@ class ZoomableImage(customtkinter.CTkLabel):
     def get_image_transformed(self, pil_image):
         if pil_image is None:
             return
-        
-        mat_inv = np.linalg.inv(self.mat_affine)
 
-        affine_inv = (
-            mat_inv[0, 0], mat_inv[0, 1], mat_inv[0, 2],
-            mat_inv[1, 0], mat_inv[1, 1], mat_inv[1, 2]
-        )
-
-        dst = pil_image.copy()
+        affine = self.mat_affine
+        key = (affine.tobytes(), self.width, self.height, self.interacting)
+        if pil_image is self._base_source and key == self._base_key:
+            # Only the annotations changed, the view is the same
+            return self._base
+        if self.pyramid is None or self.pyramid.base is not pil_image:
+            self.pyramid = ImagePyramid(pil_image)
+        # Sample from the coarsest level that still covers the current scale
+        if self.interacting:
+            src, affine = self.pyramid.select(affine, self.motion_level_bias)
+            resample = self.motion_resample
+        else:
+            src, affine = self.pyramid.select(affine)
+            resample = self.resample
 
-        dst = dst.transform(
-            (self.width, self.height),
-            Image.AFFINE,
-            affine_inv,
-            Image.BILINEAR
-        )
+        dst = render_view(src, affine, (self.width, self.height), resample)
+        self._base_source, self._base_key, self._base = pil_image, key, dst
 
         return dst
 
@@ -281,23 +335,84 @@ class ZoomableImage(customtkinter.CTkLabel):
 
         dst = self.get_image_transformed(self.pil_image)
 
-        self.show_image(dst)
+        self.set_view(dst)
+
+    def set_view(self, view):
+        '''Show a new rendered frame, which is also the base of the transient effects'''
+        self.current_view = view
+        self.effects.set_base(view)
+        self.show_image()
+
+    def clear_effects(self, event=None):
+        frame = self.effects.render()
+        if frame is not None:
+            self.show_image(frame)
 
     def show_image(self, pil_view=None):
         if pil_view is None:
             pil_view = self.current_view
-        ctk_image = CTkImage(light_image=pil_view, size=(self.width, self.height))
-        self.configure(image=ctk_image)
+        self.display.show(pil_view)
 
     def redraw_image(self):
         '''Redraw the image'''
         if self.pil_image is None:
             return
+        if self._redraw_id is not None:
+            # The pending scheduled frame is covered by this one
+            self.after_cancel(self._redraw_id)
+            self._redraw_id = None
+            self.frames_coalesced += 1
+        if self._fit_pending:
+            self._fit_pending = False
+            self.zoom_fit()
+        start = time.perf_counter()
+        uploads = self.display.upload_time
         self.draw_image(self.pil_image)
+        self._last_render = time.perf_counter()
+        # Time spent uploading to Tk is reported apart from rendering
+        self.last_render_time = self._last_render - start - (self.display.upload_time - uploads)
+        self.render_time += self.last_render_time
+        self.frames_rendered += 1
+
+    def schedule_redraw(self):
+        '''
+        Mark the view as dirty and redraw it on the next idle cycle, at most once per frame budget.
+        Transform changes made until then are rendered together in a single frame.
+        '''
+        if self.pil_image is None:
+            return
+        if self._redraw_id is not None:
+            self.frames_coalesced += 1
+            return
+        wait = self.frame_budget - (time.perf_counter() - self._last_render)
+        if wait > 0:
+            self._redraw_id = self.after(max(1, round(wait * 1000)), self._scheduled_redraw)
+        else:
+            self._redraw_id = self.after_idle(self._scheduled_redraw)
+
+    def _scheduled_redraw(self):
+        self._redraw_id = None
+        self.redraw_image()
+
+    def render_stats(self):
+        return {
+            'rendered': self.frames_rendered,
+            'coalesced': self.frames_coalesced,
+            'render_time': self.render_time,
+            'last_render_time': self.last_render_time,
+            **self.display.stats(),
+        }
 
     def make_animation(self, final_affine, initial_affine=None, duration='auto', fps=20):
+        '''
+        Animate the transform from initial_affine to final_affine without blocking the event
+        loop. Frames are timed with after() and interpolated by elapsed time, so frames are
+        dropped when rendering overruns the frame budget. A new animation retargets the
+        running one. Motion frames are rendered in fast mode and the last one at full quality.
+        '''
+        self.cancel_animation()
         if initial_affine is None:
-            initial_affine = self.mat_affine
+            initial_affine = self.mat_affine.copy()
         
         if duration == 'auto':
             try:
@@ -313,31 +428,71 @@ class ZoomableImage(customtkinter.CTkLabel):
             except:
                 duration = 1
 
+        if not duration > 0:
+            self.mat_affine = final_affine
+            self.redraw_image()
+            return
+
+        self._animation = {
+            'initial': initial_affine,
+            'final': final_affine,
+            'start': time.perf_counter(),
+            'duration': duration,
+            'frame_time': 1 / fps,
+        }
+        self._animation_step()
+
+    def _animation_step(self):
+        self._animation_id = None
+        anim = self._animation
+        start = time.perf_counter()
+        t = (start - anim['start']) / anim['duration']
+
+        if t >= 1:
+            self._animation = None
+            self.mat_affine = anim['final']
+            self.redraw_image()
+            return
 
-        total_frames = int(duration * fps + 0.5)
-        delta_affine = (final_affine - initial_affine) / total_frames
+        self.mat_affine = anim['initial'] + (anim['final'] - anim['initial']) * t
+        self.redraw_image()
 
-        for frame_number in range(total_frames + 1):
-            start = time.time()
-            curr = initial_affine + delta_affine * frame_number
-            # affine_params = (curr[0, 0], curr[0, 1], curr[0, 2], curr[1, 0], curr[1, 1], curr[1, 2])
-            # transformed_image = self.pil_image.transform(
-            #     (self.width, self.height),
-            #     Image.AFFINE,
-            #     affine_params,
-            #     Image.BILINEAR
-            # )
+        # If the frame overran its budget, the next one is just scheduled as soon as possible
+        wait = anim['frame_time'] - (time.perf_counter() - start)
+        self._animation_id = self.after(max(1, round(wait * 1000)), self._animation_step)
 
-            # self.show_image(transformed_image)
-            self.mat_affine = curr
-            self.redraw_image()
-            self.update()
+    def cancel_animation(self):
+        '''Stop the running animation, leaving the transform where it was'''
+        if self._animation_id is not None:
+            self.after_cancel(self._animation_id)
+        self._animation_id = None
+        self._animation = None
 
-            end = time.time()
-            # print(end - start, 1/fps, end - start < 1 / fps)
-            time.sleep(max(1 / fps - (end - start), 0))
+    @property
+    def animating(self):
+        return self._animation is not None
 
-        self.mat_affine = final_affine
+    # -------------------------------------------------------------------------------
+    # Render quality
+    # -------------------------------------------------------------------------------
+
+    @property
+    def interacting(self):
+        '''Whether a drag, wheel burst or animation is active, in which case frames are rendered fast'''
+        return self._refine_id is not None or self._animation is not None
+
+    def begin_interaction(self):
+        '''Render fast frames until the input has been idle for refine_delay, then refine the view'''
+        if self._refine_id is not None:
+            self.after_cancel(self._refine_id)
+        self._refine_id = self.after(round(self.refine_delay * 1000), self.end_interaction)
+
+    def end_interaction(self):
+        if self._refine_id is not None:
+            self.after_cancel(self._refine_id)
+        self._refine_id = None
+        if self._animation is None:
+            self.redraw_image()
     
 
 class AnnotatedImage(ZoomableImage):
@@ -349,9 +504,19 @@ class AnnotatedImage(ZoomableImage):
             fill_intensity=50,
             add_category='drop',
             labeling_enabled=True,
+            lod=None,
             **kwargs
         ):
+        self.annotations_version = 0
+        self.geometry_version = 0
+        self._changed_rows = None
         self.annotations = []
+        self.overlay = AnnotationOverlay()
+        self.lod = lod if lod is not None else LODPolicy()
+        self._spatial_index = None
+        self._index_version = None
+        self.hovered_annotation = None
+        self.clicked_annotation = None
         self.default_color = default_color
         self.class_colors = class_colors
         self.fill_intensity = fill_intensity
@@ -366,6 +531,8 @@ class AnnotatedImage(ZoomableImage):
     def create_bindings(self):
         super().create_bindings()
         self.bind("<Double-Button-1>", self.toggle_annotations)
+        self.bind("<Motion>", self.on_mouse_hover)
+        self.bind("<ButtonRelease-1>", self.on_click)
         if self.labeling_enabled:
             self.bind('<Button-3>', self.save_click)
             self.bind('<B3-Motion>', self.show_new_annotation)
@@ -389,6 +556,7 @@ class AnnotatedImage(ZoomableImage):
 
     def set_annotation_bindings(self):
         self.labeling_enabled = True
+        self.unbind('<Motion>')
         self.bind('<Motion>', self.show_cursor_axes)
         self.unbind('<Button-1>')
         self.unbind('<B1-Motion>')
@@ -402,41 +570,99 @@ class AnnotatedImage(ZoomableImage):
         self.class_colors = class_colors
         if default_color is not None:
             self.default_color = default_color
+        self.overlay.invalidate()
 
     def on_annotation_hover(self, event):
         annot = event.widget.annotation
-        if annot is None:
+        if annot is None or self.pil_image is None:
             return
-        
-        dst = self.current_view
-        if dst is None:
-            dst = self.get_image_transformed(self.pil_image)
-            overlay = self.create_annotations_overlay()
-        else:
-            overlay = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
-        
-        overlay = annot.draw(overlay, color='#ff00ff', affine=self.mat_affine)
-        dst = Image.alpha_composite(dst.convert('RGBA'), overlay)
+        self.highlight_annotation(annot)
+
+    def highlight_annotation(self, annot):
+        if self.current_view is None:
+            self.redraw_image()
 
+        style = OverlayStyle(default_color='#ff00ff')
+        x1, y1, _ = self.mat_affine @ (annot.x1, annot.y1, 1)
+        x2, y2, _ = self.mat_affine @ (annot.x2, annot.y2, 1)
+        box = (round(x1), round(y1), round(x2), round(y2))
+
+        def paint(draw, ox, oy):
+            shifted = (box[0] - ox, box[1] - oy, box[2] - ox, box[3] - oy)
+            draw_fill(draw, shifted, style.default_color, style)
+            draw_outline(draw, shifted, annot, style.default_color, None, style)
+
+        dst = self.effects.render([Effect(style.extent(box, ''), paint)])
         self.show_image(dst)
 
+    # -------------------------------------------------------------------------------
+    # Spatial queries
+    # -------------------------------------------------------------------------------
+
+    @property
+    def spatial_index(self):
+        '''Grid index over the boxes of the annotations, rebuilt when the annotations change'''
+        if self._spatial_index is None or self._index_version != self.geometry_version:
+            self._spatial_index = GridIndex(annotation_columns(self.annotations)['bbox'])
+            self._index_version = self.geometry_version
+        return self._spatial_index
+
+    def viewport_indices(self, pad=0):
+        '''Indices of the annotations intersecting the viewport, padded by `pad` canvas pixels'''
+        corners = np.array([[0, 0, 1], [self.width, 0, 1], [0, self.height, 1], [self.width, self.height, 1]], dtype=np.float64)
+        points = corners @ np.linalg.inv(self.mat_affine).T
+        pad = pad / self.current_scale
+        x1, y1 = points[:, :2].min(axis=0) - pad
+        x2, y2 = points[:, :2].max(axis=0) + pad
+        return self.spatial_index.query((x1, y1, x2, y2))
+
+    def annotation_at(self, x, y):
+        '''Topmost visible annotation under the canvas point, or None'''
+        point = self.to_image_point(x, y)
+        if len(point) == 0:
+            return None
+        indices = self.spatial_index.query_point(*point)
+        if len(indices) == 0:
+            return None
+        # Only the candidates are looked up, visibility includes the confidence threshold of stores
+        if hasattr(self.annotations, 'shown'):
+            shown = self.annotations.shown(indices)
+        else:
+            shown = [self.annotations[ix].visible for ix in indices]
+        for ix, visible in zip(indices[::-1], shown[::-1]):
+            if visible:
+                return self.annotations[ix]
+        return None
+
+    def on_mouse_hover(self, event):
+        if self.pil_image is None or not self.show_annotations:
+            return
+        annot = self.annotation_at(event.x, event.y)
+        if annot == self.hovered_annotation:
+            return
+        self.hovered_annotation = annot
+        if annot is None:
+            self.clear_effects()
+        else:
+            self.highlight_annotation(annot)
+
+    def on_click(self, event):
+        press = self._press_event
+        if self.pil_image is None or press is None or not self.show_annotations:
+            return
+        if abs(event.x - press.x) > 2 or abs(event.y - press.y) > 2:
+            # It was a drag
+            return
+        annot = self.annotation_at(event.x, event.y)
+        if annot is not None:
+            self.clicked_annotation = annot
+            self.event_generate("<<AnnotationClicked>>")
 
     def show_cursor_axes(self, event):
         if self.pil_image is None:
             return
-        
-        dst = self.current_view
-        # if dst is None:
-        #     dst = self.get_image_transformed(self.pil_image)
-        #     overlay = self.create_annotations_overlay()
-        # else:
-        overlay = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
-
-        draw = ImageDraw.Draw(overlay)
-        draw.line([(0, event.y), (self.width, event.y)], fill='#ffffff40', width=2)
-        draw.line([(event.x, 0), (event.x, self.height)], fill='#ffffff40', width=2)
 
-        dst = Image.alpha_composite(dst.convert('RGBA'), overlay)
+        dst = self.effects.render(crosshair(event.x, event.y, (self.width, self.height)))
 
         self.show_image(dst)
 
@@ -448,24 +674,14 @@ class AnnotatedImage(ZoomableImage):
         if self.pil_image is None:
             return
         
-        dst = self.current_view
-        # if dst is None:
-        #     dst = self.get_image_transformed(self.pil_image)
-        #     overlay = self.create_annotations_overlay()
-        # else:
-        overlay = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
-
         x1 = min(self._first_click.x, event.x)
         y1 = min(self._first_click.y, event.y)
         x2 = max(self._first_click.x, event.x)
         y2 = max(self._first_click.y, event.y)
 
-        draw = ImageDraw.Draw(overlay)
-        draw.line([(0, event.y), (self.width, event.y)], fill='#ffffff40', width=2)
-        draw.line([(event.x, 0), (event.x, self.height)], fill='#ffffff40', width=2)
-        draw.rectangle((x1, y1, x2, y2), outline=self.class_colors[self.add_category], width=2)
-
-        dst = Image.alpha_composite(dst.convert('RGBA'), overlay)
+        effects = crosshair(event.x, event.y, (self.width, self.height))
+        effects += rectangle((x1, y1, x2, y2), self.class_colors[self.add_category], 2)
+        dst = self.effects.render(effects)
 
         self.show_image(dst)
 
@@ -480,34 +696,73 @@ class AnnotatedImage(ZoomableImage):
         annot = Annotation((x1, y1, x2, y2), self.add_category, false_negative=True)
         # self.annotations_listbox.insert(annot)
         self.annotations.append(annot)
+        self.annotations_version += 1
+        self.geometry_version += 1
+        self._changed_rows = None
         self.reset_bindings()
         self.redraw_image()
         self.event_generate("<<AnnotationFinished>>")
         
 
+    @property
+    def annotations(self):
+        return self._annotations
+
+    @annotations.setter
+    def annotations(self, annotations):
+        self._annotations = annotations
+        self.annotations_version += 1
+        self.geometry_version += 1
+        self._changed_rows = None
+
     def update_annotations(self, annotations):
         self.annotations = annotations
         self.redraw_image()
 
-    def create_annotations_overlay(self):
+    def apply_changes(self, changes):
+        '''
+        Redraw after the change records of the annotation store, repainting only the boxes
+        they touch. The spatial index is only rebuilt when boxes moved, appeared or disappeared.
+        '''
+        if not changes:
+            return
+        rows = [] if self._changed_rows is None and self.annotations_version == self.overlay.version else self._changed_rows
+        for change in changes:
+            if change.kind == INSERT or change.kind == DELETE or 'bbox' in change.fields:
+                self.geometry_version += 1
+            if change.kind == DELETE:
+                # The following rows shift and so do their labels, the overlay has to look for them
+                rows = None
+            elif rows is not None:
+                rows = rows + change.rows.tolist()
+        self.annotations_version += 1
+        self._changed_rows = rows
+        self.redraw_image()
+
+    def create_annotations_overlay(self, simplified=False):
+        '''Draw the visible annotations. The simplified overlay only has outlines, for fast frames.'''
         if self.pil_image is None:
             return
 
-        overlay = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
-        for ix, annot in enumerate(self.annotations):
-            if not annot.visible:
-                continue
-            layer = annot.draw(
-                canvas_size=(self.width, self.height),
-                fill_intensity=self.fill_intensity,
-                color=self.class_colors.get(annot.category, self.default_color),
-                affine=self.mat_affine,
-                scale=self.current_scale/self.min_scale,
-                text=str(ix + 1)
-            )
-            overlay = Image.alpha_composite(overlay, layer)
-        
-        return overlay
+        style = OverlayStyle(
+            self.class_colors,
+            self.default_color,
+            self.fill_intensity,
+            scale=self.current_scale/self.min_scale,
+            lod=self.lod,
+        )
+        changed, self._changed_rows = self._changed_rows, None
+        return self.overlay.render(
+            self.annotations,
+            self.mat_affine,
+            (self.width, self.height),
+            style,
+            simplified=simplified,
+            version=self.annotations_version,
+            changed=changed,
+            # Labels can stick out of the boxes up to 7 digits to the right
+            indices=self.viewport_indices(pad=style.pad + 7 * style.font_size),
+        )
             
     def draw_image(self, pil_image):
         if pil_image is None:
@@ -517,11 +772,16 @@ class AnnotatedImage(ZoomableImage):
         dst = self.get_image_transformed(self.pil_image)
 
         if len(self.annotations) > 0 and self.show_annotations:
-            overlay = self.create_annotations_overlay()
+            overlay = self.create_annotations_overlay(simplified=self.interacting)
             dst = Image.alpha_composite(dst.convert('RGBA'), overlay)
 
-        self.current_view = dst
-        self.show_image()
+        self.set_view(dst)
+        self.hovered_annotation = None
+
+    @property
+    def primitives_drawn(self):
+        '''Number of primitives drawn by the last overlay render, to tune the level of detail'''
+        return self.overlay.primitives
 
     def toggle_annotations(self, event=None):
         self.show_annotations = not self.show_annotations